@@ -1,6 +1,8 @@
 import numpy as np
 import logging
+import threading
 import net_config
+from collections import OrderedDict
 
 from utils import setup_logger
 import loggers as lg
@@ -11,45 +13,66 @@ class Node():
         self.state = state
         self.playerTurn = state.playerTurn
         self.id = state.id
-        self.edges = []
+        self.lock = threading.Lock() # guards the statistics when several threads search the tree
+
+        #### children statistics, one slot per legal action
+        self.actions = np.zeros(0, dtype=np.int32)
+        self.childIds = []
+        self.N = np.zeros(0, dtype=np.float64)
+        self.W = np.zeros(0, dtype=np.float64)
+        self.Q = np.zeros(0, dtype=np.float64)
+        self.P = np.zeros(0, dtype=np.float64)
+        self.visits = 0 # simulations backed up through the edges, without virtual loss
 
     def isLeaf(self):
-        if len(self.edges) > 0:
+        if len(self.actions) > 0:
             return False
         else:
             return True
 
-class Edge():
-
-    def __init__(self, inNode, outNode, prior, action):
-        self.id = inNode.state.id + '|' + outNode.state.id
-        self.inNode = inNode
-        self.outNode = outNode
-        self.playerTurn = inNode.state.playerTurn
-        self.action = action
+    def expand(self, actions, priors):
+        #child nodes are only built the first time selection walks their edge
+        size = len(actions)
+        self.childIds = [None] * size
+        self.N = np.zeros(size, dtype=np.float64)
+        self.W = np.zeros(size, dtype=np.float64)
+        self.Q = np.zeros(size, dtype=np.float64)
+        self.P = np.asarray(priors, dtype=np.float64)
+        #set last, other threads treat the node as expanded once this is set
+        self.actions = np.asarray(actions, dtype=np.int32)
 
-        self.stats =  {
-                    'N': 0,
-                    'W': 0,
-                    'Q': 0,
-                    'P': prior,
-                }
-                
 
 class MCTS():
 
     def __init__(self, root, cpuct):
         self.root = root
-        self.tree = {}
+        self.tree = OrderedDict() # least recently used first
+        self.lock = threading.RLock() # guards the tree itself
         self.cpuct = cpuct
+        self.maxNodes = net_config.MCTS_TREE_SIZE
         self.addNode(root)
-    
+
     def __len__(self):
         return len(self.tree)
 
-    def moveToLeaf(self):
+    def selectEdge(self, node):
+        # index of the child edge with the highest Q + U
+        P = node.P
+        if node is self.root:
+            epsilon = net_config.EPSILON
+            nu = np.random.dirichlet([net_config.ALPHA] * len(P))
+            P = (1-epsilon) * P + epsilon * nu
+
+        U = self.cpuct * P * np.sqrt(np.sum(node.N)) / (1 + node.N)
+        QU = node.Q + U
 
-        lg.logger_mcts.info('------MOVING TO LEAF------')
+        return int(np.argmax(QU))
+
+    def moveToLeaf(self, virtualLoss = 0, trace = False):
+        # [trace] writes this simulation to the mcts log, see loggers.traceMcts
+
+        if trace:
+            lg.logger_mcts.info('------MOVING TO LEAF------')
 
         breadcrumbs = []
         currentNode = self.root
@@ -59,77 +82,122 @@ class MCTS():
 
         while not currentNode.isLeaf():
 
-            lg.logger_mcts.info('PLAYER TURN...%d', currentNode.state.playerTurn)
-        
-            maxQU = -99999
-
-            if currentNode == self.root:
-                epsilon = net_config.EPSILON
-                nu = np.random.dirichlet([net_config.ALPHA] * len(currentNode.edges))
-            else:
-                epsilon = 0
-                nu = [0] * len(currentNode.edges)
+            if trace:
+                lg.logger_mcts.info('PLAYER TURN...%d', currentNode.state.playerTurn)
 
-            Nb = 0
-            for action, edge in currentNode.edges:
-                Nb = Nb + edge.stats['N']
+            with currentNode.lock:
+                idx = self.selectEdge(currentNode)
 
-            simulationAction, simulationEdge = currentNode.edges[0]
-            for idx, (action, edge) in enumerate(currentNode.edges):
+                if virtualLoss > 0:
+                    #discourage other pending simulations from following this edge
+                    currentNode.N[idx] += virtualLoss
+                    currentNode.W[idx] -= virtualLoss
+                    currentNode.Q[idx] = currentNode.W[idx] / currentNode.N[idx]
 
-                U = self.cpuct * \
-                    ((1-epsilon) * edge.stats['P'] + epsilon * nu[idx] )  * \
-                    np.sqrt(Nb) / (1 + edge.stats['N'])
-                    
-                Q = edge.stats['Q']
+            if trace:
+                lg.logger_mcts.info('action with highest Q + U...%d', currentNode.actions[idx])
 
-                lg.logger_mcts.info('action: %d (%d)... N = %d, P = %f, nu = %f, adjP = %f, W = %f, Q = %f, U = %f, Q+U = %f'
-                    , action, action % 7, edge.stats['N'], np.round(edge.stats['P'],6), np.round(nu[idx],6), ((1-epsilon) * edge.stats['P'] + epsilon * nu[idx] )
-                    , np.round(edge.stats['W'],6), np.round(Q,6), np.round(U,6), np.round(Q+U,6))
+            breadcrumbs.append((currentNode, idx))
+            currentNode = self.getChild(currentNode, idx, trace)
 
-                if Q + U > maxQU:
-                    maxQU = Q + U
-                    simulationAction = action
-                    simulationEdge = edge
-
-            lg.logger_mcts.info('action with highest Q + U...%d', simulationAction)
-
-            newState, value, done = currentNode.state.takeAction(simulationAction) #the value of the newState from the POV of the new playerTurn
-            currentNode = simulationEdge.outNode
-            breadcrumbs.append(simulationEdge)
+            #the value of the new state from the POV of the new playerTurn
+            if currentNode.state.isEndGame:
+                value = currentNode.state.value[0]
+                done = 1
+            else:
+                value = 0
+                done = 0
 
-        lg.logger_mcts.info('DONE...%d', done)
+        if trace:
+            lg.logger_mcts.info('DONE...%d', done)
 
         return currentNode, value, done, breadcrumbs
 
 
 
-    def backFill(self, leaf, value, breadcrumbs):
-        lg.logger_mcts.info('------DOING BACKFILL------')
+    def backFill(self, leaf, value, breadcrumbs, virtualLoss = 0, trace = False):
+        if trace:
+            lg.logger_mcts.info('------DOING BACKFILL------')
 
         currentPlayer = leaf.state.playerTurn
 
-        for edge in breadcrumbs:
-            playerTurn = edge.playerTurn
+        for node, idx in breadcrumbs:
+            playerTurn = node.playerTurn
             if playerTurn == currentPlayer:
                 direction = 1
             else:
                 direction = -1
 
-            edge.stats['N'] = edge.stats['N'] + 1
-            edge.stats['W'] = edge.stats['W'] + value * direction
-            edge.stats['Q'] = edge.stats['W'] / edge.stats['N']
-
-            lg.logger_mcts.info('updating edge with value %f for player %d... N = %d, W = %f, Q = %f'
-                , value * direction
-                , playerTurn
-                , edge.stats['N']
-                , edge.stats['W']
-                , edge.stats['Q']
-                )
-
-            edge.outNode.state.render(lg.logger_mcts)
+            with node.lock:
+                #also removes any virtual loss added by moveToLeaf
+                node.N[idx] += 1 - virtualLoss
+                node.W[idx] += value * direction + virtualLoss
+                node.Q[idx] = node.W[idx] / node.N[idx]
+                node.visits += 1
+
+            if trace:
+                lg.logger_mcts.info('updating edge with value %f for player %d... N = %d, W = %f, Q = %f'
+                    , value * direction
+                    , playerTurn
+                    , node.N[idx]
+                    , node.W[idx]
+                    , node.Q[idx]
+                    )
+
+                child = self.tree.get(node.childIds[idx])
+                if child is not None:
+                    child.state.render(lg.logger_mcts)
+
+    def getChild(self, node, idx, trace = False):
+        with self.lock:
+            child = self.tree.get(node.childIds[idx])
+            if child is not None:
+                self.tree.move_to_end(child.id)
+                return child
+
+        #never visited, or evicted from the tree since. The edge stats live on the parent
+        newState, _, _ = node.state.takeAction(node.actions[idx])
+
+        with self.lock:
+            child = self.tree.get(newState.id)
+            if child is None:
+                child = Node(newState)
+                self.addNode(child)
+                if trace:
+                    lg.logger_mcts.info('added node...%s...p = %f', child.id, node.P[idx])
+            else:
+                self.tree.move_to_end(child.id)
+                if trace:
+                    lg.logger_mcts.info('existing node...%s...', child.id)
+            node.childIds[idx] = child.id
+        return child
 
     def addNode(self, node):
-        self.tree[node.id] = node
-
+        with self.lock:
+            self.tree[node.id] = node
+            self.tree.move_to_end(node.id)
+
+            if len(self.tree) > self.maxNodes:
+                self.tree.move_to_end(self.root.id)
+                while len(self.tree) > self.maxNodes:
+                    nodeId, _ = self.tree.popitem(last=False)
+                    if lg.MCTS_TRACE:
+                        lg.logger_mcts.info('evicted node...%s...', nodeId)
+
+    def changeRoot(self, node):
+        with self.lock:
+            self.root = node
+            self.tree.move_to_end(node.id)
+
+            #release every node that can no longer be reached from the new root
+            reachable = set([node.id])
+            stack = [node]
+            while len(stack) > 0:
+                current = stack.pop()
+                for childId in current.childIds:
+                    if childId is not None and childId not in reachable and childId in self.tree:
+                        reachable.add(childId)
+                        stack.append(self.tree[childId])
+
+            for nodeId in [nodeId for nodeId in self.tree if nodeId not in reachable]:
+                del self.tree[nodeId]
@@ -2,10 +2,16 @@
 
 import numpy as np
 import random
+import threading
+from collections import OrderedDict
 
 import MCTS as mc
 from game import GameState
+from inference import InferenceServer
+from runtime import TFLiteModel, checkBackend
+from model import Gen_Model
 from loss import softmax_cross_entropy_with_logits
+from memory import BatchStream
 
 import net_config
 import loggers as lg
@@ -32,6 +38,40 @@ class User():
 
 
 
+class PredictionCache():
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict() # least recently used first
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            if version != self.version:
+                #the weights changed, nothing cached so far is valid
+                self.entries.clear()
+                self.version = version
+
+            entry = self.entries.get((key, version))
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end((key, version))
+            return entry
+
+    def put(self, key, version, entry):
+        with self.lock:
+            if self.size <= 0 or version != self.version:
+                return
+            self.entries[(key, version)] = entry
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+
 class Agent():
     def __init__(self, name, state_size, action_size, mcts_simulations, cpuct, model):
         self.name = name
@@ -42,9 +82,15 @@ class Agent():
         self.cpuct = cpuct
 
         self.MCTSsimulations = mcts_simulations
+        self.threads = net_config.MCTS_THREADS
         self.model = model
+        checkBackend(net_config.INFERENCE_BACKEND)
+        self.backend = net_config.INFERENCE_BACKEND
+        self.runtime = None
+        self.server = None
 
         self.mcts = None
+        self.cache = PredictionCache(net_config.PREDICTION_CACHE_SIZE)
 
         self.train_overall_loss = []
         self.train_value_loss = []
@@ -54,24 +100,107 @@ class Agent():
         self.val_policy_loss = []
 
     
-    def simulate(self):
+    def simulate(self, model = None, virtualLoss = 0):
+        trace = lg.traceMcts()
 
-        lg.logger_mcts.info('ROOT NODE...%s', self.mcts.root.state.id)
-        self.mcts.root.state.render(lg.logger_mcts)
-        lg.logger_mcts.info('CURRENT PLAYER...%d', self.mcts.root.state.playerTurn)
+        if trace:
+            lg.logger_mcts.info('ROOT NODE...%s', self.mcts.root.state.id)
+            self.mcts.root.state.render(lg.logger_mcts)
+            lg.logger_mcts.info('CURRENT PLAYER...%d', self.mcts.root.state.playerTurn)
 
         ##### MOVE THE LEAF NODE
-        leaf, value, done, breadcrumbs = self.mcts.moveToLeaf()
-        leaf.state.render(lg.logger_mcts)
+        leaf, value, done, breadcrumbs = self.mcts.moveToLeaf(virtualLoss, trace)
+        if trace:
+            leaf.state.render(lg.logger_mcts)
 
         ##### EVALUATE THE LEAF NODE
-        value, breadcrumbs = self.evaluateLeaf(leaf, value, done, breadcrumbs)
+        value, breadcrumbs = self.evaluateLeaf(leaf, value, done, breadcrumbs, model, trace)
 
         ##### BACKFILL THE VALUE THROUGH THE TREE
-        self.mcts.backFill(leaf, value, breadcrumbs)
-
-
-    def act(self, state, tau):
+        self.mcts.backFill(leaf, value, breadcrumbs, virtualLoss, trace)
+
+    def simulateBatch(self, batchSize):
+        virtualLoss = net_config.VIRTUAL_LOSS
+        trace = lg.traceMcts()
+
+        ##### MOVE TO UP TO batchSize LEAF NODES, SPREAD OUT BY VIRTUAL LOSS
+        paths = []
+        pending = {}
+        for i in range(batchSize):
+            leaf, value, done, breadcrumbs = self.mcts.moveToLeaf(virtualLoss, trace)
+            paths.append((leaf, value, done, breadcrumbs))
+            if done == 0:
+                if leaf.id in pending:
+                    #the virtual loss could not steer this one elsewhere, evaluate what we have
+                    break
+                pending[leaf.id] = leaf
+
+        ##### EVALUATE THE NEW LEAF NODES IN ONE PREDICT CALL
+        if trace:
+            lg.logger_mcts.info('------EVALUATING %d LEAVES------', len(pending))
+        leaves = list(pending.values())
+        values = {}
+        if len(leaves) > 0:
+            preds = self.get_preds_batch([leaf.state for leaf in leaves])
+            for leaf, (value, priors, allowedActions) in zip(leaves, preds):
+                values[leaf.id] = value
+                self.expandLeaf(leaf, priors, allowedActions)
+
+        ##### BACKFILL THE VALUES THROUGH THE TREE
+        for leaf, value, done, breadcrumbs in paths:
+            if done == 0:
+                value = values[leaf.id]
+            self.mcts.backFill(leaf, value, breadcrumbs, virtualLoss, trace)
+
+        return len(paths)
+
+    def simulateThreaded(self, simulations, deadline, stop):
+        ##### SEVERAL THREADS SEARCH THE SAME TREE, SPREAD OUT BY VIRTUAL LOSS
+        if self.server == None or len(self.server.responses) != self.threads or self.server.model is not self.predictor():
+            #one server batches the leaves of all the threads into shared predict calls
+            if self.server != None:
+                self.server.close()
+            self.server = InferenceServer(self.predictor(), net_config.INFERENCE_MAX_BATCH, net_config.INFERENCE_MAX_WAIT, self.threads, local=True)
+            self.clients = [self.server.client() for i in range(self.threads)]
+
+        lock = threading.Lock()
+        started = [0]
+        completed = [0]
+
+        def search(model):
+            while True:
+                with lock:
+                    if self.searchFinished(started[0], simulations, deadline, stop, completed[0]):
+                        return
+                    started[0] += 1
+                self.simulate(model, net_config.VIRTUAL_LOSS)
+                with lock:
+                    completed[0] += 1
+
+        workers = [threading.Thread(target=search, args=(client,)) for client in self.clients]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def searchFinished(self, sim, simulations, deadline, stop, completed = None):
+        # [sim] simulations were started and [completed] of them finished, all of them if not given
+        if sim >= simulations:
+            return True
+        if completed == None:
+            completed = sim
+        #the search can only end early once the root has been expanded and one of its edges visited.
+        #root.N also counts the virtual loss of simulations still running, root.visits does not
+        if completed < 2 or (self.mcts.root.visits == 0 and not self.mcts.root.isLeaf()):
+            return False
+        return (stop != None and stop.is_set()) or (deadline != None and time.time() >= deadline)
+
+    def search(self, state, simulations = None, deadline = None, stop = None):
+        # [simulations] defaults to MCTSsimulations and may be infinite, [deadline] is a time.time()
+        # after which to stop searching and [stop] a threading.Event that ends the search when set
+
+        if simulations == None:
+            simulations = self.MCTSsimulations
 
         if self.mcts == None or state.id not in self.mcts.tree:
             self.buildMCTS(state)
@@ -79,11 +208,19 @@ class Agent():
             self.changeRootMCTS(state)
 
         #### run the simulation
-        for sim in range(self.MCTSsimulations):
-            lg.logger_mcts.info('***************************')
-            lg.logger_mcts.info('****** SIMULATION %d ******', sim + 1)
-            lg.logger_mcts.info('***************************')
-            self.simulate()
+        if self.threads > 1:
+            self.simulateThreaded(simulations, deadline, stop)
+        else:
+            sim = 0
+            while not self.searchFinished(sim, simulations, deadline, stop):
+                if net_config.MCTS_BATCH_SIZE > 1:
+                    sim += self.simulateBatch(min(net_config.MCTS_BATCH_SIZE, simulations - sim))
+                else:
+                    self.simulate()
+                    sim += 1
+
+    def act(self, state, tau, simulations = None, deadline = None, stop = None):
+        self.search(state, simulations, deadline, stop)
 
         #### get action values
         pi, values = self.getAV(1)
@@ -99,76 +236,104 @@ class Agent():
         lg.logger_mcts.info('CHOSEN ACTION...%d', action)
         lg.logger_mcts.info('MCTS PERCEIVED VALUE...%f', value)
         lg.logger_mcts.info('NN PERCEIVED VALUE...%f', NN_value)
+        lg.logger_mcts.info('PREDICTION CACHE...hits = %d, misses = %d', self.cache.hits, self.cache.misses)
 
         return (action, pi, value, NN_value)
 
 
     def get_preds(self, state):
         #predict the leaf
-        inputToModel = np.array([self.model.convertToModelInput(state)])
+        return self.get_preds_batch([state])[0]
 
-        preds = self.model.predict(inputToModel)
-        value_array = preds[0]
-        logits_array = preds[1]
-        value = value_array[0]
 
-        logits = logits_array[0]
+    def predictor(self):
+        #the model positions are evaluated with, exported again whenever the weights change
+        #a model that is not a keras network, like a RemoteModel, is already what predicts
+        if self.backend != 'tflite' or not isinstance(self.model, Gen_Model) or not hasattr(self.model, 'version'):
+            return self.model
+        if self.runtime == None or self.runtime.version != self.model.version:
+            self.runtime = TFLiteModel.fromModel(self.model, net_config.TFLITE_QUANTIZE)
+        return self.runtime
+
+    def get_preds_batch(self, states, model = None):
+        if model == None:
+            model = self.predictor()
+        version = self.model.version
 
-        allowedActions = state.allowedActions
+        #only run the model on positions it has not seen with these weights
+        cached = [self.cache.get(state.id, version) for state in states]
+        missing = [i for i, entry in enumerate(cached) if entry is None]
 
-        mask = np.ones(logits.shape,dtype=bool)
-        mask[allowedActions] = False
-        logits[mask] = -100
+        if len(missing) > 0:
+            #the engine evaluations in the input planes are run for all the leaves at once
+            GameState.encodeMany([states[i] for i in missing])
+            inputToModel = np.array([self.model.convertToModelInput(states[i]) for i in missing])
 
-        #SOFTMAX
-        odds = np.exp(logits)
-        probs = odds / np.sum(odds) ###put this just before the for?
+            preds = model.predict(inputToModel)
+            value_array = preds[0]
+            logits_array = preds[1]
 
-        return ((value, probs, allowedActions))
+            priors = self.decodePolicies(logits_array, [states[i].allowedActions for i in missing])
 
+            for row, i in enumerate(missing):
+                cached[i] = (value_array[row][0], priors[row])
+                self.cache.put(states[i].id, version, cached[i])
 
-    def evaluateLeaf(self, leaf, value, done, breadcrumbs):
+        #the priors are in the order of allowedActions
+        return [(value, priors, state.allowedActions) for state, (value, priors) in zip(states, cached)]
 
-        lg.logger_mcts.info('------EVALUATING LEAF------')
+
+    def decodePolicies(self, logits_array, legalActions):
+        # the softmax of each row of [logits_array] over its legal moves only, [legalActions]
+        # holds the allowed actions of each row. The legal logits are gathered into one padded
+        # array so the whole batch is decoded at once
+        counts = np.array([len(actions) for actions in legalActions], dtype=np.int64)
+        width = max(int(np.max(counts)), 1)
+        valid = np.arange(width) < counts[:, None]
+
+        padded = np.zeros((len(legalActions), width), dtype=np.int64)
+        padded[valid] = np.concatenate([np.asarray(actions, dtype=np.int64) for actions in legalActions])
+
+        logits = np.where(valid, logits_array[np.arange(len(legalActions))[:, None], padded], -np.inf)
+        shift = np.max(logits, axis=1, keepdims=True)
+        shift[counts == 0] = 0
+        odds = np.exp(logits - shift)
+        #the largest legal logit gives exp(0) = 1, so only rows without legal moves sum below 1
+        probs = odds / np.maximum(np.sum(odds, axis=1, keepdims=True), 1)
+
+        return [probs[row, :count] for row, count in enumerate(counts)]
+
+
+    def evaluateLeaf(self, leaf, value, done, breadcrumbs, model = None, trace = False):
+
+        if trace:
+            lg.logger_mcts.info('------EVALUATING LEAF------')
 
         if done == 0:
     
-            value, probs, allowedActions = self.get_preds(leaf.state)
-            lg.logger_mcts.info('PREDICTED VALUE FOR %d: %f', leaf.state.playerTurn, value)
-            probs = probs[allowedActions]
-            for idx, action in enumerate(allowedActions):
-                try:
-                    newState, _, _ = leaf.state.takeAction(action)
-                except AssertionError as e:
-                    print(e)
-                    print(allowedActions, list(leaf.state.board.legal_moves))
-                    assert False
-                if newState.id not in self.mcts.tree:
-                    node = mc.Node(newState)
-                    self.mcts.addNode(node)
-                    lg.logger_mcts.info('added node...%s...p = %f', node.id, probs[idx])
-                else:
-                    node = self.mcts.tree[newState.id]
-                    lg.logger_mcts.info('existing node...%s...', node.id)
+            value, priors, allowedActions = self.get_preds_batch([leaf.state], model)[0]
+            if trace:
+                lg.logger_mcts.info('PREDICTED VALUE FOR %d: %f', leaf.state.playerTurn, value)
+            self.expandLeaf(leaf, priors, allowedActions)
 
-                newEdge = mc.Edge(leaf, node, probs[idx], action)
-                leaf.edges.append((action, newEdge))
-                
-        else:
+        elif trace:
             lg.logger_mcts.info('GAME VALUE FOR %d: %f', leaf.playerTurn, value)
 
         return ((value, breadcrumbs))
 
+    def expandLeaf(self, leaf, priors, allowedActions):
+        with leaf.lock:
+            #another thread may have expanded it while this one was evaluating
+            if leaf.isLeaf():
+                leaf.expand(allowedActions, priors)
 
-        
     def getAV(self, tau):
-        edges = self.mcts.root.edges
-        pi = np.zeros(self.action_size, dtype=np.integer)
+        root = self.mcts.root
+        pi = np.zeros(self.action_size, dtype=np.float64)
         values = np.zeros(self.action_size, dtype=np.float32)
-        
-        for action, edge in edges:
-            pi[action] = pow(edge.stats['N'], 1/tau)
-            values[action] = edge.stats['Q']
+
+        pi[root.actions] = np.power(root.N, 1/tau)
+        values[root.actions] = root.Q
 
         pi = pi / (np.sum(pi) * 1.0)
         return pi, values
@@ -189,19 +354,20 @@ class Agent():
         lg.logger_mcts.info('******RETRAINING MODEL******')
 
 
-        for i in range(net_config.TRAINING_LOOPS):
-            minibatch = random.sample(ltmemory, min(net_config.BATCH_SIZE, len(ltmemory)))
+        #one fit over a stream of batches, built on background threads while the model trains.
+        #each of the TRAINING_LOOPS epochs covers BATCH_SIZE positions EPOCHS times
+        stream = BatchStream(ltmemory, net_config.FIT_BATCH_SIZE, self.model.convertBatchToModelInput, net_config.TRAINING_WORKERS, net_config.TRAINING_PREFETCH)
+        steps = int(np.ceil(net_config.BATCH_SIZE / net_config.FIT_BATCH_SIZE)) * net_config.EPOCHS
+        try:
+            fit = self.model.fit_generator(stream, steps_per_epoch=steps, epochs=net_config.TRAINING_LOOPS, verbose=1)
+        finally:
+            stream.close()
+        lg.logger_mcts.info('NEW LOSS %s', fit.history)
 
-            training_states = np.array([self.model.convertToModelInput(row['state']) for row in minibatch])
-            training_targets = {'value_head': np.array([row['value'] for row in minibatch])
-                                , 'policy_head': np.array([row['AV'] for row in minibatch])} 
-
-            fit = self.model.fit(training_states, training_targets, epochs=net_config.EPOCHS, verbose=1, validation_split=0, batch_size = 32)
-            lg.logger_mcts.info('NEW LOSS %s', fit.history)
-
-            self.train_overall_loss.append(round(fit.history['loss'][net_config.EPOCHS - 1],4))
-            self.train_value_loss.append(round(fit.history['value_head_loss'][net_config.EPOCHS - 1],4)) 
-            self.train_policy_loss.append(round(fit.history['policy_head_loss'][net_config.EPOCHS - 1],4)) 
+        for i in range(net_config.TRAINING_LOOPS):
+            self.train_overall_loss.append(round(fit.history['loss'][i],4))
+            self.train_value_loss.append(round(fit.history['value_head_loss'][i],4)) 
+            self.train_policy_loss.append(round(fit.history['policy_head_loss'][i],4)) 
 
         plt.plot(self.train_overall_loss, 'k')
         plt.plot(self.train_value_loss, 'k:')
@@ -228,4 +394,4 @@ class Agent():
 
     def changeRootMCTS(self, state):
         lg.logger_mcts.info('****** CHANGING ROOT OF MCTS TREE TO %s FOR AGENT %s ******', state.id, self.name)
-        self.mcts.root = self.mcts.tree[state.id]
\ No newline at end of file
+        self.mcts.changeRoot(self.mcts.tree[state.id])
\ No newline at end of file
@@ -33,6 +33,6 @@ HIDDEN_CNN_LAYERS = [
 	]
 
 #### EVALUATION
-EVAL_EPISODES = 25
+EVAL_EPISODES = 150
 SCORING_THRESHOLD = 1.3
 
@@ -2,5 +2,11 @@
 engine_config = {
     'NAME' : 'Manush',
     'VERSION' : 'v0.0',
-    'AUTHORS' : 'Thomas Koconis and Archie Sravankumar'
+    'AUTHORS' : 'Thomas Koconis and Archie Sravankumar',
+    'RUN_NUMBER' : None, # archived run to play with, None for the current run folder
+    'MODEL_VERSION' : None, # saved version to play with, None for an untrained network
+    'MOVE_OVERHEAD' : 50, # ms kept back on every move for GUI and communication lag
+    'MOVES_TO_GO' : 30, # moves the remaining clock is split over when the GUI does not say
+    'MAX_THREADS' : 64,
+    'ROOT_PROCESSES' : 1 # processes searching their own tree from the root, more than 1 merges their visit counts
 }
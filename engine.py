@@ -1,10 +1,15 @@
 import chess
+import math
+import threading
+import time
 from chess import Board
 from eng_config import engine_config
 import net_config
 from game import Game, GameState
 from agent import Agent
+from ensemble import RootEnsemble
 from model import Residual_CNN
+from runtime import checkBackend
 
 
 class Engine:
@@ -12,9 +17,14 @@ class Engine:
         self._config = engine_config
         self._game = Game()
         NN = Residual_CNN(net_config.REG_CONST, net_config.LEARNING_RATE, self._game.input_shape, self._game.action_size, net_config.HIDDEN_CNN_LAYERS)
-        network = NN.read(self._game.name, run_version, player1version) #not sure what to put for [run_version] or [player1version]
-        NN.model.set_weights(network.get_weights())   
+        if self._config['MODEL_VERSION'] != None:
+            NN.load_version(self._game.name, self._config['RUN_NUMBER'], self._config['MODEL_VERSION'])
         self._agent = Agent(self._config['NAME'], self._game.state_size, self._game.action_size, net_config.MCTS_SIMS, net_config.CPUCT, NN)
+        self._ensemble = None
+        self._stop = threading.Event()
+        self._search = None
+        self._fen = None
+        self._moves = []
     
     def name(self):
         return self._config['NAME']
@@ -23,45 +33,166 @@ class Engine:
         return self._config['VERSION']
 
     def author(self):
-        return self._config['AUTHOR']
+        return self._config['AUTHORS']
 
+    """
+    [options()] returns the UCI options the engine supports, as they should be 
+    printed after "option" in reply to "uci".
+    """
+    def options(self):
+        return ['name Threads type spin default {} min 1 max {}'.format(net_config.MCTS_THREADS, self._config['MAX_THREADS'])
+            , 'name Backend type combo default {} var keras var tflite'.format(net_config.INFERENCE_BACKEND)]
+
+    def setoption(self, name, value):
+        self.stop()
+        if name.lower() == 'threads':
+            self._agent.threads = max(1, min(int(value), self._config['MAX_THREADS']))
+        elif name.lower() == 'backend' and value.lower() in ('keras', 'tflite'):
+            checkBackend(value.lower())
+            self._agent.backend = value.lower()
+            #the ensemble workers took the backend when they started, new ones are started on the next search
+            if self._ensemble != None:
+                self._ensemble.close()
+                self._ensemble = None
+
+    """
+    [setposition(fen, moves)] sets the position to [fen] (the starting position 
+    if None) followed by [moves]. When this extends the game the engine already 
+    has, only the new moves are played, and the search tree built so far stays 
+    usable for the next search.
+    """
     def setposition(self, fen=None, moves=None):
-        if fen:
-            new_board = Board(fen)
+        self.stop()
+        moves = moves or []
+        if fen == self._fen and moves[:len(self._moves)] == self._moves:
+            new_moves = moves[len(self._moves):]
+            if not new_moves:
+                return
+            new_board = self._game.gameState.board.copy()
         else:
-            new_board = Board()
-        if moves:
-            for move in moves:
-                new_board.push_uci(move)
+            new_moves = moves
+            if fen:
+                new_board = Board(fen)
+            else:
+                new_board = Board()
+        for move in new_moves:
+            new_board.push_uci(move)
+        self._fen = fen
+        self._moves = list(moves)
         self._game.gameState = GameState(board=new_board)
 
-    def best_move(self): 
-        
-        if self._game.gameState.board.fullmove_number < net_config.turns_until_tau0:
-                action, _, _, _ = self._agent.act(self._game.gameState, 1)
+    """
+    [time_budget(...)] returns how many seconds to spend on the next move given
+    the clock information of a UCI "go" command, or None when there is no
+    clock to manage. Times are in milliseconds as sent by the GUI.
+    """
+    def time_budget(self, wtime=None, btime=None, winc=0, binc=0, movestogo=None, movetime=None):
+        overhead = self._config['MOVE_OVERHEAD']
+        if movetime != None:
+            return max(movetime - overhead, 1) / 1000
+
+        if self._game.gameState.board.turn == chess.WHITE:
+            remaining, increment = wtime, winc
         else:
-            action, _, _, _ = self._agent.act(self._game.gameState, 0)
-        
-        from_square, to_square = divmod(action, 64)
-        
-        best = chess.Move(from_square=from_square, to_square=to_square).uci()
+            remaining, increment = btime, binc
+        if remaining == None:
+            return None
+
+        moves_left = movestogo if movestogo else self._config['MOVES_TO_GO']
+        budget = remaining / moves_left + increment * 0.75
+        #never plan to use more than half the clock, whatever the increment
+        budget = min(budget, remaining / 2) - overhead
+        return max(budget, 1) / 1000
+
+    """
+    [best_move(...)] searches the current position and returns the best move in
+    UCI notation. The search ends after [nodes] simulations (MCTS_SIMS by
+    default), when the time budget for the given clock runs out or when
+    [stop()] is called, whichever comes first. With [infinite] it only ends on
+    [stop()].
+    """
+    def best_move(self, wtime=None, btime=None, winc=0, binc=0, movestogo=None, movetime=None, nodes=None, infinite=False):
+        budget = self.time_budget(wtime, btime, winc, binc, movestogo, movetime)
+        deadline = None if (infinite or budget == None) else time.time() + budget
+        if infinite or (budget != None and nodes == None):
+            simulations = math.inf
+        else:
+            simulations = nodes
+
+        if self._game.gameState.board.fullmove_number < net_config.TURNS_UNTIL_TAU0:
+            tau = 1
+        else:
+            tau = 0
+        pi = None
+        if self._config['ROOT_PROCESSES'] > 1:
+            #independent searches in worker processes, their root statistics are merged
+            if self._ensemble == None:
+                self._ensemble = RootEnsemble(self._agent, self._config['ROOT_PROCESSES'])
+            try:
+                pi, values = self._ensemble.search(self._game.gameState.board, simulations, deadline, self._stop)
+            except RuntimeError:
+                #a worker died: this move is searched here, new workers are started for the next one
+                self._ensemble = None
+
+        if pi is not None:
+            action, _ = self._agent.chooseAction(pi, values, tau)
+        else:
+            action, _, _, _ = self._agent.act(self._game.gameState, tau, simulations, deadline, self._stop)
+
+        best = self._game.gameState._actionToMove(action).uci()
 
         self._game.step(action)
+        self._moves.append(best)
 
         return best
 
+    """
+    [start_search(callback, ...)] runs [best_move(...)] on a background thread
+    and calls [callback] with the move found, so the caller can keep reading
+    commands such as "stop" meanwhile. If the search fails, [callback] still
+    gets a legal move, or the null move "0000" when there is none.
+    """
+    def start_search(self, callback, **limits):
+        self.wait()
+        self._stop.clear()
+        fallback = next(iter(self._game.gameState.board.legal_moves), None)
+
+        def search():
+            best = None
+            try:
+                best = self.best_move(**limits)
+            finally:
+                #the GUI waits for a bestmove whatever happened to the search
+                if best == None:
+                    best = fallback.uci() if fallback != None else '0000'
+                callback(best)
+
+        self._search = threading.Thread(target=search, daemon=True)
+        self._search.start()
+
+    def wait(self):
+        if self._search != None:
+            self._search.join()
+            self._search = None
+
     def stop(self):
-        pass
+        self._stop.set()
+        self.wait()
 
     def reset(self):
+        self.stop()
         self._agent.mcts = None
         self._game.reset()
+        self._fen = None
+        self._moves = []
     
     """
     minimax search of the game tree up to a depth of [depth], using evaluation 
     function [eval_func]. Includes alpha-beta pruning optimization
     """
-    def minimax_search(self, depth, eval_func, player, board=_board, alpha=-1001, beta=1001, next=None):
+    def minimax_search(self, depth, eval_func, player, board=None, alpha=-1001, beta=1001, next=None):
+        if board == None:
+            board = self._game.gameState.board
         if (depth == 0 or board.is_game_over()):
             return eval_func(board), next
         if player:
@@ -0,0 +1,119 @@
+"""
+Contains the root-parallel search ensemble used by the engine.
+
+Each worker process keeps its own agent and its own MCTS tree and searches
+the same position independently, with its own Dirichlet noise at the root.
+The root visit counts and values of all the trees are merged before a move is
+chosen, so the processes never share or lock anything during the search.
+"""
+
+import queue
+import random
+
+import numpy as np
+
+import net_config
+from game import Game, GameState
+from model import Residual_CNN
+from agent import Agent
+from utils import spawnContext
+
+
+def _searchWorker(spec, tasks, results, stop):
+    name, mcts_simulations, cpuct, backend = spec
+
+    env = Game()
+    NN = Residual_CNN(net_config.REG_CONST, net_config.LEARNING_RATE, env.input_shape, env.action_size, net_config.HIDDEN_CNN_LAYERS)
+    agent = Agent(name, env.state_size, env.action_size, mcts_simulations, cpuct, NN)
+    agent.backend = backend
+    #the processes are the parallelism here, one search thread each
+    agent.threads = 1
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        board, simulations, deadline, seed, weights = task
+
+        if weights != None:
+            NN.set_weights(weights)
+            agent.mcts = None
+        np.random.seed(seed)
+        random.seed(seed)
+
+        #the tree of the previous search is kept, so a reply the parent already explored is reused
+        agent.search(GameState(board=board), simulations, deadline, stop)
+        root = agent.mcts.root
+        results.put((root.actions, root.N, root.W))
+
+
+"""
+[RootEnsemble(agent, processes)] starts [processes] worker processes, each
+searching with a copy of [agent]'s network and settings.
+"""
+class RootEnsemble:
+    def __init__(self, agent, processes):
+        self.agent = agent
+        self.version = None
+
+        ctx = spawnContext()
+        self.stop = ctx.Event()
+        self.results = ctx.Queue()
+        self.tasks = [ctx.Queue() for i in range(processes)]
+        spec = (agent.name, agent.MCTSsimulations, agent.cpuct, agent.backend)
+        self.workers = [ctx.Process(target=_searchWorker, args=(spec, tasks, self.results, self.stop), daemon=True) for tasks in self.tasks]
+        for worker in self.workers:
+            worker.start()
+
+    """
+    [search(board, simulations, deadline, stop)] runs one search per worker
+    from [board], each with up to [simulations] simulations and until
+    [deadline], and returns the merged (pi, values) like Agent.getAV(1).
+    Setting the threading.Event [stop] ends all the searches early. Raises
+    RuntimeError, after stopping the other workers, if a worker died.
+    """
+    def search(self, board, simulations, deadline = None, stop = None):
+        #the workers only get the weights again when they changed since the last search
+        weights = None
+        if self.agent.model.version != self.version:
+            weights = self.agent.model.get_weights()
+            self.version = self.agent.model.version
+
+        self.stop.clear()
+        for tasks in self.tasks:
+            tasks.put((board, simulations, deadline, np.random.randint(2**31), weights))
+
+        N = np.zeros(self.agent.action_size, dtype=np.float64)
+        W = np.zeros(self.agent.action_size, dtype=np.float64)
+        received = 0
+        while received < len(self.workers):
+            try:
+                actions, workerN, workerW = self.results.get(timeout=0.05)
+            except queue.Empty:
+                if stop != None and stop.is_set():
+                    self.stop.set()
+                if not all(worker.is_alive() for worker in self.workers):
+                    #its result will never come
+                    self.terminate()
+                    raise RuntimeError('a root search worker died')
+                continue
+            np.add.at(N, actions, workerN)
+            np.add.at(W, actions, workerW)
+            received += 1
+
+        values = np.zeros(self.agent.action_size, dtype=np.float32)
+        visited = N > 0
+        values[visited] = W[visited] / N[visited]
+        pi = N / np.sum(N)
+        return pi, values
+
+    def close(self):
+        for tasks in self.tasks:
+            tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def terminate(self):
+        for worker in self.workers:
+            worker.terminate()
+            worker.join()
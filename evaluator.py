@@ -0,0 +1,119 @@
+"""
+Contains the pool of UCI engines used to score positions for the feature
+planes built by GameState.
+
+The engines run on a background asyncio loop through chess.engine's asyncio
+API, so several positions can be analysed at once, one per engine process.
+"""
+
+import asyncio
+import atexit
+import threading
+import chess
+import chess.engine
+from chess.polyglot import zobrist_hash
+
+
+"""
+[AnalysisService(command, processes, popen)] starts [processes] copies of the
+UCI engine at [command].
+
+Parameter popen: coroutine function called with [command] that returns a
+(transport, engine) pair like chess.engine.popen_uci. Tests can pass one that
+returns a local stub engine with async analyse() and quit() methods.
+"""
+class AnalysisService:
+    def __init__(self, command, processes = 1, popen = chess.engine.popen_uci):
+        self.command = command
+        self.processes = processes
+        self.popen = popen
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+        self.restarts = 0
+        self.inflight = {}
+        self.closed = False
+        self._call(self._start())
+        atexit.register(self.close)
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _start(self):
+        self.idle = asyncio.Queue()
+        for i in range(self.processes):
+            self.idle.put_nowait(await self._spawn())
+
+    async def _spawn(self):
+        _, engine = await self.popen(self.command)
+        return engine
+
+    async def _analyse(self, key, board, limit):
+        engine = await self.idle.get()
+        try:
+            try:
+                info = await engine.analyse(board, limit)
+            except (chess.engine.EngineError, chess.engine.EngineTerminatedError):
+                #the engine crashed or got confused, replace it and try once more
+                try:
+                    await engine.quit()
+                except Exception:
+                    pass
+                self.restarts += 1
+                engine = await self._spawn()
+                info = await engine.analyse(board, limit)
+            return info['score'].pov(board.turn)
+        finally:
+            self.idle.put_nowait(engine)
+            del self.inflight[key]
+
+    async def _submit(self, board, limit, key):
+        key = (zobrist_hash(board) if key is None else key, limit.depth, limit.time)
+        #identical positions already being analysed share the same request
+        if key not in self.inflight:
+            self.inflight[key] = asyncio.ensure_future(self._analyse(key, board.copy(stack=False), limit))
+        return await self.inflight[key]
+
+    async def _gather(self, boards, limit, keys):
+        return await asyncio.gather(*[self._submit(board, limit, key) for board, key in zip(boards, keys)])
+
+    """
+    [submit(board, limit, key)] queues [board] for analysis and returns a
+    concurrent.futures.Future of its score from the point of view of the side
+    to move. [key] is the position's zobrist hash if already known.
+    """
+    def submit(self, board, limit, key = None):
+        return asyncio.run_coroutine_threadsafe(self._submit(board, limit, key), self.loop)
+
+    """
+    [analyse(board, limit, key)] blocks until [board] has been analysed and
+    returns its score from the point of view of the side to move.
+    """
+    def analyse(self, board, limit, key = None):
+        return self.submit(board, limit, key).result()
+
+    """
+    [analyse_many(boards, limit, keys)] analyses all of [boards] concurrently
+    across the pool and returns their scores in the same order.
+    """
+    def analyse_many(self, boards, limit, keys = None):
+        if keys is None:
+            keys = [None] * len(boards)
+        return self._call(self._gather(boards, limit, keys))
+
+    async def _close(self):
+        while not self.idle.empty():
+            engine = self.idle.get_nowait()
+            try:
+                await engine.quit()
+            except Exception:
+                pass
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._call(self._close())
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
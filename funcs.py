@@ -1,10 +1,14 @@
 import numpy as np
 import random
+import logging
 
 import loggers as lg
 
 from game import Game, GameState
 from model import Residual_CNN
+from memory import Memory
+from inference import InferenceServer, RemoteModel
+from utils import spawnContext
 
 from agent import Agent, User
 import chess.pgn
@@ -18,8 +22,7 @@ def playMatchesBetweenVersions(env, run_version, player1version, player2version,
         player1_NN = Residual_CNN(net_config.REG_CONST, net_config.LEARNING_RATE, env.input_shape,   env.action_size, net_config.HIDDEN_CNN_LAYERS)
 
         if player1version > 0:
-            player1_network = player1_NN.read(env.name, run_version, player1version)
-            player1_NN.model.set_weights(player1_network.get_weights())   
+            player1_NN.load_version(env.name, run_version, player1version)
         player1 = Agent('player1', env.state_size, env.action_size, net_config.MCTS_SIMS, net_config.CPUCT, player1_NN)
 
     if player2version == -1:
@@ -28,8 +31,7 @@ def playMatchesBetweenVersions(env, run_version, player1version, player2version,
         player2_NN = Residual_CNN(net_config.REG_CONST, net_config.LEARNING_RATE, env.input_shape,   env.action_size, net_config.HIDDEN_CNN_LAYERS)
         
         if player2version > 0:
-            player2_network = player2_NN.read(env.name, run_version, player2version)
-            player2_NN.model.set_weights(player2_network.get_weights())
+            player2_NN.load_version(env.name, run_version, player2version)
         player2 = Agent('player2', env.state_size, env.action_size, net_config.MCTS_SIMS, net_config.CPUCT, player2_NN)
 
     scores, memory, points, sp_scores = playMatches(player1, player2, EPISODES, logger, turns_until_tau0, None, goes_first)
@@ -37,7 +39,8 @@ def playMatchesBetweenVersions(env, run_version, player1version, player2version,
     return (scores, memory, points, sp_scores)
 
 
-def playMatches(player1, player2, EPISODES, logger, turns_until_tau0, memory = None, goes_first = 0):
+def playMatches(player1, player2, EPISODES, logger, turns_until_tau0, memory = None, goes_first = 0, stop = None):
+    # [stop], if given, is called with the scores after each episode and ends the match early by returning True
 
     env = Game()
     scores = {player1.name:0, "drawn": 0, player2.name:0}
@@ -144,4 +147,190 @@ def playMatches(player1, player2, EPISODES, logger, turns_until_tau0, memory = N
                 points[players[state.playerTurn]['name']].append(pts[0])
                 points[players[-state.playerTurn]['name']].append(pts[1])
 
+        if stop != None and stop(scores):
+            logger.info('MATCH DECIDED AFTER %d OF %d EPISODES', e+1, EPISODES)
+            break
+
     return (scores, memory, points, sp_scores)
+
+
+class SPRT():
+    # Sequential probability ratio test of whether [player] scores [score1] or more against [opponent]
+    # (H1) rather than [score0] (H0), a win counting 1 and a draw 1/2. Pass decided as the stop of a
+    # match: once the log likelihood ratio crosses a bound, [result] is True to accept H1 or False to
+    # accept H0, with error rates [alpha] and [beta]. It stays None while the match is undecided.
+    def __init__(self, player, opponent, score0 = None, score1 = None, alpha = None, beta = None):
+        self.player = player
+        self.opponent = opponent
+        self.score0 = net_config.SPRT_SCORE0 if score0 == None else score0
+        self.score1 = net_config.SPRT_SCORE1 if score1 == None else score1
+        alpha = net_config.SPRT_ALPHA if alpha == None else alpha
+        beta = net_config.SPRT_BETA if beta == None else beta
+        self.lower = np.log(beta / (1 - alpha))
+        self.upper = np.log((1 - beta) / alpha)
+        self.llr = 0
+        self.result = None
+
+    def decided(self, scores):
+        wins, draws, losses = scores[self.player], scores['drawn'], scores[self.opponent]
+        games = wins + draws + losses
+        if games == 0:
+            return False
+
+        score = (wins + draws / 2) / games
+        #the variance of a game's score, with half a game of each result added so a few
+        #identical results do not make it zero
+        w, d, l = wins + 0.5, draws + 0.5, losses + 0.5
+        mean = (w + d / 2) / (w + d + l)
+        variance = (w * (1 - mean) ** 2 + d * (0.5 - mean) ** 2 + l * mean ** 2) / (w + d + l)
+
+        #normal approximation of the log likelihood ratio of H1 against H0
+        self.llr = games * (self.score1 - self.score0) * (2 * score - self.score0 - self.score1) / (2 * variance)
+        if self.llr >= self.upper:
+            self.result = True
+        elif self.llr <= self.lower:
+            self.result = False
+        return self.result != None
+
+    def promote(self, scores, threshold, logger):
+        # whether the match with [scores] promotes [player]. Without an SPRT decision once all
+        # the games were played, it wins [threshold] times as many games as [opponent] or it fails
+        games = scores[self.player] + scores['drawn'] + scores[self.opponent]
+        if self.result == None:
+            logger.info('GATE UNDECIDED BY THE SPRT AFTER THE CAP OF %d GAMES, LLR %.2f, USING THE SCORE RATIO', games, self.llr)
+            return scores[self.player] > scores[self.opponent] * threshold
+        logger.info('GATE DECIDED BY THE SPRT AFTER %d GAMES, LLR %.2f, %s', games, self.llr, 'PROMOTE' if self.result else 'REJECT')
+        return self.result
+
+
+#### players of the current worker process, built once by _initWorker
+_workerPlayers = None
+
+def _initWorker(playerSpecs):
+    global _workerPlayers
+    np.random.seed()
+    random.seed()
+
+    env = Game()
+    agents = {}
+    for name, mcts_simulations, cpuct, weights, handle in playerSpecs:
+        if name not in agents:
+            if handle != None:
+                #predictions come from the inference server in the parent process
+                NN = RemoteModel(handle)
+            else:
+                NN = Residual_CNN(net_config.REG_CONST, net_config.LEARNING_RATE, env.input_shape, env.action_size, net_config.HIDDEN_CNN_LAYERS)
+                NN.set_weights(weights)
+            agents[name] = Agent(name, env.state_size, env.action_size, mcts_simulations, cpuct, NN)
+    _workerPlayers = [agents[spec[0]] for spec in playerSpecs]
+
+def _playEpisode(args):
+    loggerName, turns_until_tau0, keepMemory, goes_first = args
+    player1, player2 = _workerPlayers
+
+    memory = Memory(net_config.MEMORY_SIZE) if keepMemory else None
+    scores, memory, points, sp_scores = playMatches(player1, player2, 1, logging.getLogger(loggerName), turns_until_tau0, memory, goes_first)
+    entries = memory.ltmemory.rows() if keepMemory else None
+
+    return (scores, entries, points, sp_scores)
+
+
+def playMatchesParallel(player1, player2, EPISODES, logger, turns_until_tau0, memory = None, goes_first = 0, processes = None, stop = None):
+    # Same as playMatches, but the episodes are spread over a pool of worker processes,
+    # each with its own copy of the agents. Both players must be Agents.
+    if processes is None:
+        processes = net_config.SELF_PLAY_PROCESSES
+    if processes <= 1 or EPISODES <= 1:
+        return playMatches(player1, player2, EPISODES, logger, turns_until_tau0, memory, goes_first, stop)
+
+    scores = {player1.name:0, "drawn": 0, player2.name:0}
+    sp_scores = {'sp':0, "drawn": 0, 'nsp':0}
+    points = {player1.name:[], player2.name:[]}
+
+    processes = min(processes, EPISODES)
+    servers = {}
+    playerSpecs = []
+    for player in (player1, player2):
+        if net_config.INFERENCE_SERVER:
+            if player.name not in servers:
+                servers[player.name] = InferenceServer(player.predictor(), net_config.INFERENCE_MAX_BATCH, net_config.INFERENCE_MAX_WAIT, processes)
+            playerSpecs.append((player.name, player.MCTSsimulations, player.cpuct, None, servers[player.name].handle()))
+        else:
+            playerSpecs.append((player.name, player.MCTSsimulations, player.cpuct, player.model.get_weights(), None))
+    episode = (logger.name, turns_until_tau0, memory != None, goes_first)
+
+    pool = spawnContext().Pool(processes, _initWorker, (playerSpecs,))
+    try:
+        #a stopping rule sees the games in the order they were started, as finishing order favours short games
+        results = pool.imap(_playEpisode, [episode] * EPISODES) if stop != None else pool.imap_unordered(_playEpisode, [episode] * EPISODES)
+        for e, (ep_scores, entries, ep_points, ep_sp_scores) in enumerate(results):
+            logger.info('EPISODE %d OF %d FINISHED', e+1, EPISODES)
+
+            for name in ep_scores:
+                scores[name] = scores[name] + ep_scores[name]
+            for name in ep_sp_scores:
+                sp_scores[name] = sp_scores[name] + ep_sp_scores[name]
+            for name in ep_points:
+                points[name].extend(ep_points[name])
+
+            if memory != None:
+                memory.ltmemory.extend_rows(entries)
+
+            if stop != None and stop(scores):
+                #the episodes still being played are not needed any more
+                logger.info('MATCH DECIDED AFTER %d OF %d EPISODES', e+1, EPISODES)
+                pool.terminate()
+                break
+    finally:
+        pool.close()
+        pool.join()
+        for name, server in servers.items():
+            server.close()
+            logger.info('INFERENCE SERVER FOR %s: %s', name, server.stats())
+
+    return (scores, memory, points, sp_scores)
+
+
+def memoryDiagnostics(buffer, players, logger, size = None, dump = None):
+    # Compares the predictions of each of [players] with the MCTS targets of [size] random positions
+    # of the ReplayBuffer [buffer], with one batched predict per player. Logs and returns one record
+    # of the value mean squared error, the KL divergence of the predicted policy from the MCTS one
+    # and how often both pick the same move. With [dump], every prediction is logged as well
+    size = net_config.MEMORY_SAMPLE_SIZE if size == None else size
+    dump = net_config.MEMORY_SAMPLE_DUMP if dump == None else dump
+
+    samp = buffer.batch(buffer.sample(min(size, len(buffer))))
+    legalActions = [np.flatnonzero(legal) for legal in samp['legal']]
+    record = {'positions': len(samp['value'])}
+    values = {}
+    policies = {}
+
+    for player in players:
+        preds = player.predict(player.model.convertBatchToModelInput(samp['state']))
+        values[player.name] = preds[0][:, 0]
+        #the decoded rows follow the order of the legal mask, so they fill it directly
+        policies[player.name] = np.zeros(samp['AV'].shape, dtype=np.float32)
+        policies[player.name][samp['legal']] = np.concatenate(player.decodePolicies(preds[1], legalActions))
+
+        target = samp['AV']
+        logRatio = np.log(np.maximum(target, 1e-8)) - np.log(np.maximum(policies[player.name], 1e-8))
+        record[player.name] = {
+            'value_mse': round(float(np.mean((values[player.name] - samp['value']) ** 2)), 4)
+            , 'policy_kl': round(float(np.mean(np.sum(np.where(target > 0, target * logRatio, 0), axis=1))), 4)
+            , 'top1_agreement': round(float(np.mean(np.argmax(policies[player.name], axis=1) == np.argmax(target, axis=1))), 4)
+            }
+
+    logger.info('MEMORY SAMPLE: %s', record)
+
+    if dump:
+        for i in range(len(samp['value'])):
+            logger.info('MCTS VALUE FOR %s: %f', samp['playerTurn'][i], samp['value'][i])
+            for player in players:
+                logger.info('%s PRED VALUE: %f', player.name, values[player.name][i])
+            logger.info('THE MCTS ACTION VALUES: %s', ['%.2f' % elem for elem in samp['AV'][i]])
+            for player in players:
+                logger.info('%s PRED ACTION VALUES: %s', player.name, ['%.2f' % elem for elem in policies[player.name][i]])
+            logger.info('ID: %s', samp['id'][i])
+            logger.info('INPUT TO MODEL: %s', samp['state'][i])
+
+    return record
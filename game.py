@@ -5,6 +5,9 @@ import chess
 import chess.engine
 from itertools import product
 from chess.engine import Cp, Mate, MateGiven
+from chess.polyglot import zobrist_hash, ZobristHasher, POLYGLOT_RANDOM_ARRAY
+from evaluator import AnalysisService
+import net_config
 
 class Game:
 
@@ -37,63 +40,131 @@ class Game:
         return identities
 
 
+"""
+[encodeBoards(boards, evaluations, out)] writes the (B,20,8,8) model input for
+[boards] into [out], allocating it when not given. Planes 0-11 are the side to
+move's then the opponent's pawns to kings, seen from the side to move. Planes
+12-19 are turn, move count, no-progress count, the four castling rights and
+the engine evaluation taken from [evaluations].
+"""
+def encodeBoards(boards, evaluations, out = None):
+    count = len(boards)
+    if out is None:
+        out = np.empty((count, 20, 8, 8), dtype=np.float32)
+
+    bitboards = []
+    scalars = []
+    for board, evaluation in zip(boards, evaluations):
+        pieces = (board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings)
+        for color in (board.turn, not board.turn):
+            bitboards.extend([mask & board.occupied_co[color] for mask in pieces])
+        scalars.append((board.turn, board.fullmove_number, board.halfmove_clock,
+            board.has_kingside_castling_rights(chess.WHITE), board.has_queenside_castling_rights(chess.WHITE),
+            board.has_kingside_castling_rights(chess.BLACK), board.has_queenside_castling_rights(chess.BLACK),
+            evaluation))
+
+    # one byte per rank, least significant bit is the a-file
+    ranks = np.array(bitboards, dtype='<u8').view(np.uint8).reshape(count, 12, 8, 1)
+    planes = np.unpackbits(ranks, axis=3)[:, :, :, ::-1]
+    scalars = np.array(scalars, dtype=np.float32)
+
+    black = scalars[:, 0] == 0
+    out[:, :12] = planes
+    out[black, :12] = planes[black][:, :, ::-1, :]
+    out[:, 12:] = scalars[:, :, None, None]
+    return out
+
+
 class GameState():
-    engine = chess.engine.SimpleEngine.popen_uci('./stockfish')
-    def __init__(self, board = None):
+    evaluator = None # shared AnalysisService, started on first use
+    hasher = ZobristHasher(POLYGLOT_RANDOM_ARRAY)
+    #keys of the halfmove clock and the move number, fixed so every process builds the same ids
+    counterKeys = [[int(key) for key in keys] for keys in np.random.RandomState(0).randint(0, 2**64, size=(2, 256), dtype=np.uint64)]
+
+    @staticmethod
+    def getEvaluator():
+        if GameState.evaluator is None:
+            GameState.evaluator = AnalysisService(net_config.STOCKFISH_PATH, net_config.STOCKFISH_PROCESSES)
+        return GameState.evaluator
+
+    def __init__(self, board = None, key = None):
         if not board:
             self.board = Board()
         else:
             self.board = board
         self.pieces = {'1':'W', '0': '-', '-1':'B'}
         self.playerTurn = 1 if self.board.turn else -1
-        self.binary = self._binary()
-        self.id = self.board.fen()
+        self.id = key if key is not None else self._convertStateToId()
+        self.planes = None # the model input, built on first use or by GameState.encodeMany
         self.allowedActions = self._allowedActions()
         self.isEndGame = self._checkForEndGame()
         self.value = self._getValue()
         self.score = self._getScore()
 
+    def __setstate__(self, state):
+        #states pickled by older versions kept the planes as binary and used the FEN as id
+        if 'binary' in state:
+            state['planes'] = state.pop('binary')
+        self.__dict__.update(state)
+        if isinstance(self.id, str):
+            self.id = self._convertStateToId()
+
     def _allowedActions(self):
         allowedActions = [self._moveToAction(move) 
             for move 
             in self.board.legal_moves]
         return allowedActions
 
-    def _binary(self):
-        pieces = list(product(
-            [chess.WHITE, chess.BLACK], 
-            range(chess.PAWN, chess.KING + 1)))
-        layers = []
-        board = self.board if self.board.turn else self.board.mirror()        
-        for col, typ in pieces:
-            piece_position_lst = board.pieces(typ, col).tolist()
-            piece_position_array = np.reshape(np.array(piece_position_lst), (8,8)).astype(np.uint8)
-            layers.append(piece_position_array)
-
-        turn = np.ones((8,8)) * self.board.turn 
-        move_count = np.ones((8,8)) * self.board.fullmove_number
-        no_progress = np.ones((8,8)) * self.board.halfmove_clock
-        p1_k_castle = np.ones((8,8)) * self.board.has_kingside_castling_rights(chess.WHITE)
-        p1_q_castle = np.ones((8,8)) * self.board.has_queenside_castling_rights(chess.WHITE)
-        p2_k_castle = np.ones((8,8)) * self.board.has_kingside_castling_rights(chess.BLACK)
-        p2_q_castle = np.ones((8,8)) * self.board.has_queenside_castling_rights(chess.BLACK)
-        repetition = np.ones((8,8))
-        try:
-            info = GameState.engine.analyse(self.board, chess.engine.Limit(depth=5))
-            score = info['score'].pov(self.board.turn)
-            if score.is_mate():
-                repetition = np.ones((8,8)) * score.mate()
-            else:
-                repetition = np.ones((8,8)) * score.score() / 1000 
-        except Exception:
-            GameState.engine = chess.engine.SimpleEngine.popen_uci('./stockfish')
-
-        layers.extend([turn, move_count, no_progress, p1_k_castle, 
-            p1_q_castle, p2_k_castle, p2_q_castle, repetition])
-        return np.stack(layers, axis=0)
+    @property
+    def binary(self):
+        if self.planes is None:
+            GameState.encodeMany([self])
+        return self.planes
+
+    @staticmethod
+    def encodeMany(states):
+        # builds the model input of each of [states] that has none yet. The positions are
+        # analysed concurrently across the engine pool and encoded as one batch
+        states = [state for state in states if state.planes is None]
+        if len(states) == 0:
+            return
+
+        scores = GameState.getEvaluator().analyse_many([state.board for state in states], chess.engine.Limit(depth=net_config.STOCKFISH_DEPTH), [state.id for state in states])
+        evaluations = [score.mate() if score.is_mate() else score.score() / 1000 for score in scores]
+        for state, planes in zip(states, encodeBoards([state.board for state in states], evaluations)):
+            state.planes = planes
 
     def _convertStateToId(self):
-        return self.board.fen()
+        #the move counters are in the key as well: the model input and the move limit depend on them,
+        #and a position repeated later in the game must not be merged into the earlier node
+        return zobrist_hash(self.board) ^ self._counterKey(self.board)
+
+    def _counterKey(self, board):
+        keys = GameState.counterKeys
+        return keys[0][board.halfmove_clock % 256] ^ keys[1][board.fullmove_number % 256]
+
+    def _pieceKey(self, board, square):
+        piece = board.piece_at(square)
+        if not piece:
+            return 0
+        return GameState.hasher.array[64 * ((piece.piece_type - 1) * 2 + int(piece.color)) + square]
+
+    def _nextId(self, move, newBoard):
+        # updates this state's zobrist key for [move] instead of rehashing [newBoard]
+        hasher = GameState.hasher
+        squares = [move.from_square, move.to_square]
+        if self.board.is_castling(move):
+            squares.extend(chess.SquareSet(chess.BB_RANK_1 if self.board.turn else chess.BB_RANK_8))
+        elif self.board.is_en_passant(move):
+            squares.append(chess.square(chess.square_file(move.to_square), chess.square_rank(move.from_square)))
+
+        key = self.id ^ hasher.array[780]
+        key ^= hasher.hash_castling(self.board) ^ hasher.hash_castling(newBoard)
+        key ^= hasher.hash_ep_square(self.board) ^ hasher.hash_ep_square(newBoard)
+        key ^= self._counterKey(self.board) ^ self._counterKey(newBoard)
+        for square in set(squares):
+            key ^= self._pieceKey(self.board, square) ^ self._pieceKey(newBoard, square)
+        return key
 
     def _checkForEndGame(self):
         if self.board.fullmove_number < 150:
@@ -106,8 +177,7 @@ class GameState():
         # This is the value of the state for the current player
         # i.e. if the previous player played a winning move, you lose
         if self.board.fullmove_number >= 150:
-            info = GameState.engine.analyse(self.board, chess.engine.Limit(time=0.05))
-            score = info['score'].pov(self.board.turn)
+            score = GameState.getEvaluator().analyse(self.board, chess.engine.Limit(time=0.05), self.id)
             zero = chess.engine.Cp(0)
             print(score,end='')
             if score == zero:
@@ -173,7 +243,7 @@ class GameState():
         move = self._actionToMove(action)
         newBoard = self.board.copy()
         newBoard.push(move)        
-        newState = GameState(board=newBoard)
+        newState = GameState(board=newBoard, key=self._nextId(move, newBoard))
         value = 0
         done = 0
 
@@ -187,6 +257,5 @@ class GameState():
 
 
     def render(self, logger):
-        for r in range(6):
-            logger.info(self.board.fen())
+        logger.info(self.board.fen())
         logger.info('--------------')
@@ -0,0 +1,166 @@
+"""
+Contains the batching inference server that lets many agents, in this process
+or in worker processes, share one Residual_CNN.
+
+Callers send their inputs through a request queue. The server thread gathers
+them into one batch until the batch is full or the oldest request has waited
+[maxWait] seconds, runs a single predict and sends each caller its rows back.
+"""
+
+import atexit
+import os
+import queue
+import threading
+import time
+from collections import Counter, deque
+
+import numpy as np
+import tensorflow as tf
+
+from model import toModelLayout
+from utils import spawnContext
+
+
+"""
+[InferenceServer(model, maxBatchSize, maxWait, maxClients, local)] serves
+predictions from [model], a Gen_Model, to RemoteModel clients, at most
+[maxClients] of their predict calls at a time. With [local] the clients can
+only be threads of this process, which saves pickling every request.
+"""
+class InferenceServer:
+    def __init__(self, model, maxBatchSize, maxWait, maxClients, local = False):
+        self.model = model
+        self.maxBatchSize = maxBatchSize
+        self.maxWait = maxWait
+
+        #otherwise spawn queues, so handles can be given to spawned worker processes
+        Queue = queue.Queue if local else spawnContext().Queue
+        self.requests = Queue()
+        self.responses = [Queue() for i in range(maxClients)]
+        self.slots = Queue()
+        for slot in range(maxClients):
+            self.slots.put(slot)
+
+        self.batchSizes = Counter()
+        self.latencies = deque(maxlen=10000)
+        self.queueDepths = deque(maxlen=10000)
+
+        #keras needs the predict function built and the graph set to predict from another thread
+        if hasattr(self.model, 'model'):
+            self.model.model._make_predict_function()
+        self.graph = tf.get_default_graph()
+
+        self.running = True
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    """
+    [handle()] returns what a RemoteModel needs to talk to this server. It can
+    be passed to a process when it is started.
+    """
+    def handle(self):
+        return (self.requests, self.responses, self.slots, self.model.planes_dim, self.model.data_format, self.model.version)
+
+    def client(self):
+        return RemoteModel(self.handle())
+
+    def _nextBatch(self):
+        request = self.requests.get()
+        if request is None:
+            return []
+
+        batch = [request]
+        rows = len(request[2])
+        deadline = time.time() + self.maxWait
+        while rows < self.maxBatchSize:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                self.running = False
+                break
+            batch.append(request)
+            rows += len(request[2])
+
+        return batch
+
+    def _serve(self):
+        while self.running:
+            batch = self._nextBatch()
+            if len(batch) == 0:
+                break
+
+            try:
+                self.queueDepths.append(self.requests.qsize())
+            except NotImplementedError:
+                pass
+
+            inputs = np.concatenate([request[2] for request in batch])
+            with self.graph.as_default():
+                preds = self.model.predict(inputs)
+            self.batchSizes[len(inputs)] += 1
+
+            start = 0
+            now = time.time()
+            for slot, requestId, rows, sent in batch:
+                end = start + len(rows)
+                self.responses[slot].put((requestId, self.model.version, preds[0][start:end], preds[1][start:end]))
+                self.latencies.append(now - sent)
+                start = end
+
+    """
+    [stats()] returns the recent queue depth, the histogram of batch sizes and
+    the 50th/90th/99th percentile request latency in milliseconds.
+    """
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000
+        return {
+            'queue_depth': np.mean(self.queueDepths) if len(self.queueDepths) > 0 else 0
+            , 'batch_sizes': dict(sorted(self.batchSizes.items()))
+            , 'latency_ms': dict((p, np.percentile(latencies, p)) for p in (50, 90, 99)) if len(latencies) > 0 else {}
+            }
+
+    def close(self):
+        if self.running:
+            self.running = False
+            self.requests.put(None)
+            self.thread.join()
+
+
+"""
+[RemoteModel(handle)] stands in for a Gen_Model in an Agent, sending its
+predictions to the InferenceServer that gave out [handle]. Each thread or
+process needs its own RemoteModel. A predict call holds one of the server's
+slots until its answer is back, so at most maxClients calls wait at once.
+"""
+class RemoteModel:
+    def __init__(self, handle):
+        self.requests, self.responses, self.slots, self.planes_dim, self.data_format, self.version = handle
+        #request ids are unique across clients, as the slots are shared
+        self.client = (os.getpid(), id(self))
+        self.requestId = 0
+
+    def predict(self, x):
+        self.requestId += 1
+        requestId = (self.client, self.requestId)
+        slot = self.slots.get()
+        try:
+            self.requests.put((slot, requestId, x, time.time()))
+            while True:
+                answered, version, value, policy = self.responses[slot].get()
+                #an answer left behind by a call interrupted before it came
+                if answered == requestId:
+                    break
+        finally:
+            self.slots.put(slot)
+        self.version = version
+        return [value, policy]
+
+    def convertToModelInput(self, state):
+        inputToModel = toModelLayout(np.reshape(state.binary, self.planes_dim), self.data_format)
+        return (inputToModel)
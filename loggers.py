@@ -1,4 +1,5 @@
 
+import itertools
 from utils import setup_logger
 from settings import run_folder
 
@@ -9,10 +10,22 @@ LOGGER_DISABLED = {
 'main':False
 , 'memory':False
 , 'tourney':False
-, 'mcts':False
+, 'mcts':True
 , 'model': False}
 
 
+### MCTS tracing is checked before building any message, so it costs nothing while disabled
+### when enabled, one simulation in MCTS_TRACE_EVERY is written to the mcts log
+
+MCTS_TRACE = not LOGGER_DISABLED['mcts']
+MCTS_TRACE_EVERY = 100
+
+_mctsSimulations = itertools.count()
+
+def traceMcts():
+    return MCTS_TRACE and next(_mctsSimulations) % MCTS_TRACE_EVERY == 0
+
+
 logger_mcts = setup_logger('logger_mcts', run_folder + 'logs/logger_mcts.log')
 logger_mcts.disabled = LOGGER_DISABLED['mcts']
 
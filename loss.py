@@ -6,13 +6,18 @@ def softmax_cross_entropy_with_logits(y_true, y_pred):
     p = y_pred
     pi = y_true
 
-    zero = tf.zeros(shape = tf.shape(pi), dtype=tf.float32)
-    where = tf.equal(pi, zero)
-
-    negatives = tf.fill(tf.shape(pi), -100.0) 
-    p = tf.where(where, negatives, p)
-
-    loss = tf.nn.softmax_cross_entropy_with_logits(labels = pi, logits = p)
+    #only the moves with a target probability take part in the softmax, the others count as
+    #masked out. Works from one 0/1 mask rather than building full size fill tensors to mask with
+    support = tf.cast(tf.greater(pi, 0.0), tf.float32)
+
+    #shift by the largest supported logit so the exponentials cannot overflow
+    shift = tf.stop_gradient(tf.reduce_max(p - (1.0 - support) * 1e9, axis=-1, keepdims=True))
+    odds = tf.exp(tf.minimum(p - shift, 0.0)) * support
+    #the largest supported logit adds exp(0) = 1, so only a row without any target sums below 1.
+    #Such a row would take the log of 0, the floor makes its loss 0 instead of NaN
+    logsumexp = tf.log(tf.maximum(tf.reduce_sum(odds, axis=-1), 1.0)) + tf.squeeze(shift, axis=-1)
+
+    loss = logsumexp * tf.reduce_sum(pi, axis=-1) - tf.reduce_sum(pi * p, axis=-1)
 
     return loss
 
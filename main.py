@@ -15,7 +15,8 @@ from game import Game, GameState
 from agent import Agent
 from memory import Memory
 from model import Residual_CNN
-from funcs import playMatches, playMatchesBetweenVersions
+from funcs import playMatches, playMatchesParallel, playMatchesBetweenVersions, SPRT, memoryDiagnostics
+from pipeline import Pipeline
 
 import loggers as lg
 
@@ -24,121 +25,115 @@ import initialise
 import pickle
 
 
-lg.logger_main.info('=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*')
-lg.logger_main.info('=*=*=*=*=*=.      NEW LOG      =*=*=*=*=*')
-lg.logger_main.info('=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*')
+#worker processes started with spawn re-import this module, they must not run it
+if __name__ == '__main__':
 
-env = Game()
+    lg.logger_main.info('=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*')
+    lg.logger_main.info('=*=*=*=*=*=.      NEW LOG      =*=*=*=*=*')
+    lg.logger_main.info('=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*')
 
-# If loading an existing neural network, copy the net_config file to root
-if initialise.INITIAL_RUN_NUMBER != None:
-    copyfile(run_archive_folder  + env.name + '/run' + str(initialise.INITIAL_RUN_NUMBER).zfill(4) + '/net_config.py', './net_config.py')
+    env = Game()
 
-import net_config
+    # If loading an existing neural network, copy the net_config file to root
+    if initialise.INITIAL_RUN_NUMBER != None:
+        copyfile(run_archive_folder  + env.name + '/run' + str(initialise.INITIAL_RUN_NUMBER).zfill(4) + '/net_config.py', './net_config.py')
 
-######## LOAD MEMORIES IF NECESSARY ########
+    import net_config
 
-if initialise.INITIAL_MEMORY_VERSION == None:
-    memory = Memory(net_config.MEMORY_SIZE)
-else:
-    print('LOADING MEMORY VERSION ' + str(initialise.INITIAL_MEMORY_VERSION) + '...')
-    memory = pickle.load( open( run_archive_folder + env.name + '/run' + str(initialise.INITIAL_RUN_NUMBER).zfill(4) + "/memory/memory" + str(initialise.INITIAL_MEMORY_VERSION).zfill(4) + ".p",   "rb" ) )
+    ######## LOAD MEMORIES IF NECESSARY ########
 
-######## LOAD MODEL IF NECESSARY ########
+    if initialise.INITIAL_MEMORY_VERSION == None:
+        memory = Memory(net_config.MEMORY_SIZE)
+    else:
+        print('LOADING MEMORY VERSION ' + str(initialise.INITIAL_MEMORY_VERSION) + '...')
+        memory = pickle.load( open( run_archive_folder + env.name + '/run' + str(initialise.INITIAL_RUN_NUMBER).zfill(4) + "/memory/memory" + str(initialise.INITIAL_MEMORY_VERSION).zfill(4) + ".p",   "rb" ) )
+
+    ######## LOAD MODEL IF NECESSARY ########
+
+    # create an untrained neural network objects from the net_config file
+    current_NN = Residual_CNN(net_config.REG_CONST, net_config.LEARNING_RATE, (2,) + env.grid_shape,   env.action_size, net_config.HIDDEN_CNN_LAYERS)
+    best_NN = Residual_CNN(net_config.REG_CONST, net_config.LEARNING_RATE, (2,) +  env.grid_shape,   env.action_size, net_config.HIDDEN_CNN_LAYERS)
+
+    #If loading an existing neural netwrok, set the weights from that model
+    if initialise.INITIAL_MODEL_VERSION != None:
+        best_player_version  = initialise.INITIAL_MODEL_VERSION
+        print('LOADING MODEL VERSION ' + str(initialise.INITIAL_MODEL_VERSION) + '...')
+        current_NN.load_version(env.name, initialise.INITIAL_RUN_NUMBER, best_player_version)
+        best_NN.load_version(env.name, initialise.INITIAL_RUN_NUMBER, best_player_version)
+    #otherwise just ensure the weights on the two players are the same
+    else:
+        best_player_version = 0
+        best_NN.set_weights(current_NN.model.get_weights())
 
-# create an untrained neural network objects from the net_config file
-current_NN = Residual_CNN(net_config.REG_CONST, net_config.LEARNING_RATE, (2,) + env.grid_shape,   env.action_size, net_config.HIDDEN_CNN_LAYERS)
-best_NN = Residual_CNN(net_config.REG_CONST, net_config.LEARNING_RATE, (2,) +  env.grid_shape,   env.action_size, net_config.HIDDEN_CNN_LAYERS)
+    #copy the net_config file to the run folder
+    copyfile('./net_config.py', run_folder + 'net_config.py')
+    plot_model(current_NN.model, to_file=run_folder + 'models/model.png', show_shapes = True)
 
-#If loading an existing neural netwrok, set the weights from that model
-if initialise.INITIAL_MODEL_VERSION != None:
-    best_player_version  = initialise.INITIAL_MODEL_VERSION
-    print('LOADING MODEL VERSION ' + str(initialise.INITIAL_MODEL_VERSION) + '...')
-    m_tmp = best_NN.read(env.name, initialise.INITIAL_RUN_NUMBER, best_player_version)
-    current_NN.model.set_weights(m_tmp.get_weights())
-    best_NN.model.set_weights(m_tmp.get_weights())
-#otherwise just ensure the weights on the two players are the same
-else:
-    best_player_version = 0
-    best_NN.model.set_weights(current_NN.model.get_weights())
+    print('\n')
 
-#copy the net_config file to the run folder
-copyfile('./net_config.py', run_folder + 'net_config.py')
-plot_model(current_NN.model, to_file=run_folder + 'models/model.png', show_shapes = True)
+    ######## CREATE THE PLAYERS ########
 
-print('\n')
+    current_player = Agent('current_player', env.state_size, env.action_size, net_config.MCTS_SIMS, net_config.CPUCT, current_NN)
+    best_player = Agent('best_player', env.state_size, env.action_size, net_config.MCTS_SIMS, net_config.CPUCT, best_NN)
+    #user_player = User('player1', env.state_size, env.action_size)
 
-######## CREATE THE PLAYERS ########
+    if net_config.ASYNC_PIPELINE:
+        ######## ASYNCHRONOUS TRAINING ########
+        #actors, the learner and the evaluator all run at once, until interrupted
+        Pipeline(env, memory, current_player, best_player, best_player_version, net_config.TURNS_UNTIL_TAU0).run()
 
-current_player = Agent('current_player', env.state_size, env.action_size, net_config.MCTS_SIMS, net_config.CPUCT, current_NN)
-best_player = Agent('best_player', env.state_size, env.action_size, net_config.MCTS_SIMS, net_config.CPUCT, best_NN)
-#user_player = User('player1', env.state_size, env.action_size)
-iteration = 0
+    iteration = 0
 
-while 1:
+    while 1:
 
-    iteration += 1
-    reload(lg)
-    reload(net_config)
+        iteration += 1
+        reload(lg)
+        reload(net_config)
     
-    print('ITERATION NUMBER ' + str(iteration))
+        print('ITERATION NUMBER ' + str(iteration))
     
-    lg.logger_main.info('BEST PLAYER VERSION: %d', best_player_version)
-    print('BEST PLAYER VERSION ' + str(best_player_version))
+        lg.logger_main.info('BEST PLAYER VERSION: %d', best_player_version)
+        print('BEST PLAYER VERSION ' + str(best_player_version))
 
-    ######## SELF PLAY ########
-    print('SELF PLAYING ' + str(net_config.EPISODES) + ' EPISODES...')
-    _, memory, _, _ = playMatches(best_player, best_player, net_config.EPISODES, lg.logger_main, turns_until_tau0 = net_config.TURNS_UNTIL_TAU0, memory = memory)
-    print('\n')
+        ######## SELF PLAY ########
+        print('SELF PLAYING ' + str(net_config.EPISODES) + ' EPISODES...')
+        _, memory, _, _ = playMatchesParallel(best_player, best_player, net_config.EPISODES, lg.logger_main, turns_until_tau0 = net_config.TURNS_UNTIL_TAU0, memory = memory)
+        print('\n')
     
-    memory.clear_stmemory()
+        memory.clear_stmemory()
     
-    if len(memory.ltmemory) >= net_config.MEMORY_SIZE:
-
-        ######## RETRAINING ########
-        print('RETRAINING...')
-        current_player.replay(memory.ltmemory)
-        print('')
-
-        if iteration % 5 == 0:
-            pickle.dump( memory, open( run_folder + "memory/memory" + str(iteration).zfill(4) + ".p", "wb" ) )
-
-        lg.logger_memory.info('====================')
-        lg.logger_memory.info('NEW MEMORIES')
-        lg.logger_memory.info('====================')
-        
-        memory_samp = random.sample(memory.ltmemory, min(1000, len(memory.ltmemory)))
-        
-        for s in memory_samp:
-            current_value, current_probs, _ = current_player.get_preds(s['state'])
-            best_value, best_probs, _ = best_player.get_preds(s['state'])
-
-            lg.logger_memory.info('MCTS VALUE FOR %s: %f', s['playerTurn'], s['value'])
-            lg.logger_memory.info('CUR PRED VALUE FOR %s: %f', s['playerTurn'], current_value)
-            lg.logger_memory.info('BES PRED VALUE FOR %s: %f', s['playerTurn'], best_value)
-            lg.logger_memory.info('THE MCTS ACTION VALUES: %s', ['%.2f' % elem for elem in s['AV']]  )
-            lg.logger_memory.info('CUR PRED ACTION VALUES: %s', ['%.2f' % elem for elem in  current_probs])
-            lg.logger_memory.info('BES PRED ACTION VALUES: %s', ['%.2f' % elem for elem in  best_probs])
-            lg.logger_memory.info('ID: %s', s['state'].id)
-            lg.logger_memory.info('INPUT TO MODEL: %s', current_player.model.convertToModelInput(s['state']))
-
-            s['state'].render(lg.logger_memory)
-            
-        ######## TOURNAMENT ########
-        print('TOURNAMENT...')
-        scores, _, points, sp_scores = playMatches(best_player, current_player, net_config.EVAL_EPISODES, lg.logger_tourney, turns_until_tau0 = 0, memory = None)
-        print('\nSCORES')
-        print(scores)
-        print('\nSTARTING PLAYER / NON-STARTING PLAYER SCORES')
-        print(sp_scores)
-        #print(points)
-
-        print('\n\n')
-
-        if scores['current_player'] > scores['best_player'] * net_config.SCORING_THRESHOLD:
-            best_player_version = best_player_version + 1
-            best_NN.model.set_weights(current_NN.model.get_weights())
-            best_NN.write(env.name, best_player_version)
+        if len(memory.ltmemory) >= net_config.MEMORY_SIZE:
 
-    else:
-        print('MEMORY SIZE: ' + str(len(memory.ltmemory)))
+            ######## RETRAINING ########
+            print('RETRAINING...')
+            current_player.replay(memory.ltmemory)
+            print('')
+
+            if iteration % 5 == 0:
+                pickle.dump( memory, open( run_folder + "memory/memory" + str(iteration).zfill(4) + ".p", "wb" ) )
+
+            ######## DIAGNOSTICS ########
+            #the players' predictions on a sample of the memory, against its MCTS targets
+            print('MEMORY SAMPLE', memoryDiagnostics(memory.ltmemory, (current_player, best_player), lg.logger_memory))
+            
+            ######## TOURNAMENT ########
+            print('TOURNAMENT...')
+            #stops as soon as the sequential test has decided whether to promote the current player
+            sprt = SPRT('current_player', 'best_player')
+            scores, _, points, sp_scores = playMatchesParallel(best_player, current_player, net_config.EVAL_EPISODES, lg.logger_tourney, turns_until_tau0 = 0, memory = None, stop = sprt.decided)
+            print('\nSCORES')
+            print(scores)
+            print('SPRT LLR %.2f, RESULT %s' % (sprt.llr, sprt.result))
+            print('\nSTARTING PLAYER / NON-STARTING PLAYER SCORES')
+            print(sp_scores)
+            #print(points)
+
+            print('\n\n')
+
+            if sprt.promote(scores, net_config.SCORING_THRESHOLD, lg.logger_tourney):
+                best_player_version = best_player_version + 1
+                best_NN.set_weights(current_NN.model.get_weights())
+                best_NN.write(env.name, best_player_version)
+
+        else:
+            print('MEMORY SIZE: ' + str(len(memory.ltmemory)))
@@ -1,14 +1,207 @@
 import numpy as np
+import queue
+import random
+import threading
 from collections import deque
 
 import net_config
 
+PIECE_PLANES = 12 # 0/1 planes at the front of GameState.binary, the rest hold one value each
+
+def sparsePolicy(AV, size = None):
+    # the (actions, probs) pairs of the non-zero entries of the dense policy [AV]. When there
+    # are more than [size], only the [size] most likely are kept and renormalised
+    actions = np.flatnonzero(AV)
+    if size != None and len(actions) > size:
+        actions = actions[np.argsort(AV[actions])[-size:]]
+    probs = AV[actions]
+    return actions, probs / np.sum(probs)
+
+
+class ReplayBuffer:
+    # Ring of the last [size] training positions, kept in preallocated arrays rather than as
+    # GameStates: piece planes and legal moves are bit packed, the other planes are one float each
+    # and the policy target is a few (action, probability) pairs.
+    # The arrays are allocated by the first append, sized from its entry.
+    fields = ('planes', 'scalars', 'legal', 'policyActions', 'policyProbs', 'value', 'playerTurn', 'id')
+
+    def __init__(self, size):
+        self.size = size
+        self.next = 0 # row the next position is written to, also the oldest row once full
+        self.count = 0
+        self.planes = None
+
+    def __len__(self):
+        return self.count
+
+    def _allocate(self, binary, actionSize):
+        self.shape = binary.shape
+        self.actionSize = actionSize
+        self.planes = np.zeros((self.size,) + np.packbits(binary[:PIECE_PLANES].astype(np.uint8), axis=-1).shape, dtype=np.uint8)
+        self.scalars = np.zeros((self.size, self.shape[0] - PIECE_PLANES), dtype=np.float32)
+        self.legal = np.zeros((self.size, (actionSize + 7) // 8), dtype=np.uint8)
+        #policy targets as (action, probability) pairs, the unused pairs have probability 0
+        self.policyActions = np.zeros((self.size, net_config.POLICY_TARGET_SIZE), dtype=np.int16)
+        self.policyProbs = np.zeros((self.size, net_config.POLICY_TARGET_SIZE), dtype=np.float32)
+        self.value = np.zeros(self.size, dtype=np.float32)
+        self.playerTurn = np.zeros(self.size, dtype=np.int8)
+        self.id = np.zeros(self.size, dtype=np.uint64)
+
+    def _advance(self, rows):
+        self.next = (self.next + rows) % self.size
+        self.count = min(self.count + rows, self.size)
+
+    def append(self, entry):
+        state = entry['state']
+        if self.planes is None:
+            self._allocate(state.binary, len(entry['AV']))
+
+        legal = np.zeros(self.actionSize, dtype=np.uint8)
+        legal[state.allowedActions] = 1
+        actions, probs = sparsePolicy(np.asarray(entry['AV']), net_config.POLICY_TARGET_SIZE)
+
+        i = self.next
+        self.planes[i] = np.packbits(state.binary[:PIECE_PLANES].astype(np.uint8), axis=-1)
+        self.scalars[i] = state.binary[PIECE_PLANES:, 0, 0]
+        self.legal[i] = np.packbits(legal)
+        self.policyActions[i] = 0
+        self.policyActions[i, :len(actions)] = actions
+        self.policyProbs[i] = 0
+        self.policyProbs[i, :len(probs)] = probs
+        self.value[i] = entry['value']
+        self.playerTurn[i] = entry['playerTurn']
+        self.id[i] = state.id
+        self._advance(1)
+
+    def extend(self, entries):
+        for entry in entries:
+            self.append(entry)
+
+    def rows(self):
+        #the stored arrays of every position, oldest first, e.g. to send them to another process
+        if self.count == 0:
+            return None
+        indices = (self.next - self.count + np.arange(self.count)) % self.size
+        rows = dict((name, getattr(self, name)[indices]) for name in self.fields)
+        rows['shape'] = self.shape
+        rows['actionSize'] = self.actionSize
+        return rows
+
+    def extend_rows(self, rows):
+        if rows is None:
+            return
+        if self.planes is None:
+            self.shape = rows['shape']
+            self._allocate(np.zeros(self.shape, dtype=np.float32), rows['actionSize'])
+
+        count = min(len(rows['value']), self.size)
+        indices = (self.next + np.arange(count)) % self.size
+        for name in self.fields:
+            getattr(self, name)[indices] = rows[name][-count:]
+        self._advance(count)
+
+    def sample(self, size):
+        #every row below count holds a position, whichever is the oldest
+        return np.array(random.sample(range(self.count), size), dtype=np.int64)
+
+    def batch(self, indices):
+        # the positions at [indices] with the model input unpacked to float32 planes
+        # and the policy targets made dense, only for this batch
+        count = len(indices)
+        AV = np.zeros((count, self.actionSize), dtype=np.float32)
+        np.add.at(AV, (np.arange(count)[:, None], self.policyActions[indices]), self.policyProbs[indices])
+
+        states = np.empty((len(indices),) + self.shape, dtype=np.float32)
+        states[:, :PIECE_PLANES] = np.unpackbits(self.planes[indices], axis=-1)[..., :self.shape[-1]]
+        states[:, PIECE_PLANES:] = self.scalars[indices][:, :, None, None]
+
+        return {
+            'state': states
+            , 'legal': np.unpackbits(self.legal[indices], axis=-1)[:, :self.actionSize].astype(bool)
+            , 'AV': AV
+            , 'value': self.value[indices]
+            , 'playerTurn': self.playerTurn[indices]
+            , 'id': self.id[indices]
+            }
+
+
+class BatchStream:
+    # Endless stream of (states, targets) training batches of [batchSize] positions from [buffer],
+    # shuffled across the whole buffer: every position is used once per pass, in a new order each
+    # pass. [convert] puts the stored planes in the layout of the model, e.g.
+    # Gen_Model.convertBatchToModelInput. [workers] threads assemble the batches and keep up to
+    # [prefetch] of them ready, so the next batch is built while the model trains on the current one.
+    def __init__(self, buffer, batchSize, convert, workers = 2, prefetch = 8):
+        self.buffer = buffer
+        self.batchSize = batchSize
+        self.convert = convert
+
+        self.lock = threading.Lock()
+        self.order = np.zeros(0, dtype=np.int64)
+        self.position = 0
+        self.passes = 0
+
+        self.batches = queue.Queue(prefetch)
+        self.running = True
+        self.threads = [threading.Thread(target=self._fill, daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def _nextIndices(self):
+        with self.lock:
+            if self.position + self.batchSize > len(self.order):
+                #start a new pass, the few positions left over from the last one wait for the next
+                self.order = np.random.permutation(len(self.buffer))
+                self.position = 0
+                self.passes += 1
+            indices = self.order[self.position:self.position + self.batchSize]
+            self.position += self.batchSize
+        return indices
+
+    def _fill(self):
+        while self.running:
+            try:
+                batch = self.buffer.batch(self._nextIndices())
+                item = (self.convert(batch['state']), {'value_head': batch['value'], 'policy_head': batch['AV']})
+            except Exception as e:
+                #handed to the consumer, which would otherwise wait for a batch forever
+                item = e
+            while self.running:
+                try:
+                    self.batches.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self.batches.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+
+
 class Memory:
     def __init__(self, MEMORY_SIZE):
         self.MEMORY_SIZE = net_config.MEMORY_SIZE
-        self.ltmemory = deque(maxlen=net_config.MEMORY_SIZE)
+        self.ltmemory = ReplayBuffer(net_config.MEMORY_SIZE)
         self.stmemory = deque(maxlen=net_config.MEMORY_SIZE)
 
+    def __setstate__(self, state):
+        if not isinstance(state['ltmemory'], ReplayBuffer):
+            #pickled before the replay buffer, the positions are a deque of dicts
+            ltmemory = ReplayBuffer(net_config.MEMORY_SIZE)
+            ltmemory.extend(state['ltmemory'])
+            state['ltmemory'] = ltmemory
+        self.__dict__.update(state)
+
     def commit_stmemory(self, identities, state, actionValues):
         for r in identities(state, actionValues):
             self.stmemory.append({
@@ -20,10 +213,8 @@ class Memory:
                 })
 
     def commit_ltmemory(self):
-        for i in self.stmemory:
-            self.ltmemory.append(i)
+        self.ltmemory.extend(self.stmemory)
         self.clear_stmemory()
 
     def clear_stmemory(self):
         self.stmemory = deque(maxlen=net_config.MEMORY_SIZE)
-        
\ No newline at end of file
@@ -1,6 +1,11 @@
 # %matplotlib inline
 
+import atexit
+import json
 import logging
+import os
+import queue
+import threading
 import net_config
 import numpy as np
 
@@ -19,21 +24,187 @@ import keras.backend as K
 
 from settings import run_folder, run_archive_folder
 
+def toModelLayout(planes, data_format):
+    # [planes], one or a batch of inputs stacked like GameState.binary (channels first),
+    # in the layout of a network built with [data_format]
+    if data_format == 'channels_last':
+        return np.moveaxis(planes, -3, -1)
+    return planes
+
+def _flattenOrder(shape, data_format):
+    # for each output of a Flatten in [data_format], its position in the flattened channels
+    # first tensor. [shape] is the (channels, height, width) of the tensor being flattened
+    order = np.arange(np.prod(shape)).reshape(shape)
+    if data_format == 'channels_last':
+        order = order.transpose(1, 2, 0)
+    return order.flatten()
+
+def weightsPath(game, run_number, version):
+    # the weights-only checkpoint of a version, [run_number] None for the current run
+    if run_number == None:
+        folder = run_folder
+    else:
+        folder = run_archive_folder + game + '/run' + str(run_number).zfill(4) + '/'
+    return folder + 'models/version' + "{0:0>4}".format(version) + '.npy'
+
+def shapesPath(path):
+    # the file beside the checkpoint at [path] listing the shapes of its weights, in order
+    return path[:-len('.npy')] + '.json'
+
+def weightShapes(model):
+    # the shapes of the weights of [model], a Gen_Model, in the order of get_weights: layer
+    # by layer. model.weights lists all the trainable weights before the others instead
+    return [tuple(K.int_shape(w)) for layer in model.model.layers for w in layer.weights]
+
+
+class CheckpointWriter():
+    # Saves weights-only checkpoints on a background thread, one after the other. Each is written
+    # to a temporary file first, so a checkpoint on disk is never half written
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def _write(self):
+        while True:
+            path, weights = self.queue.get()
+            try:
+                #the shapes first, a checkpoint is only there once both are
+                with open(shapesPath(path) + '.tmp', 'w') as f:
+                    json.dump([list(np.shape(w)) for w in weights], f)
+                os.replace(shapesPath(path) + '.tmp', shapesPath(path))
+                with open(path + '.tmp', 'wb') as f:
+                    np.save(f, np.concatenate([np.ravel(w) for w in weights]).astype(np.float32))
+                os.replace(path + '.tmp', path)
+            except Exception:
+                lg.logger_model.exception('could not write checkpoint %s', path)
+            finally:
+                self.queue.task_done()
+
+    def save(self, path, weights):
+        self.queue.put((path, weights))
+
+    def flush(self):
+        self.queue.join()
+
+
+class WeightRegistry():
+    # Weights of saved versions by (run, version), kept in this process once read. A checkpoint
+    # is one flat float32 array, memory mapped and split into the shapes of the model loading it.
+    # Versions saved only as full .h5 models are read with load_model, once
+    def __init__(self):
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def put(self, game, run_number, version, weights):
+        with self.lock:
+            self.versions[(run_number, version)] = [np.asarray(w, dtype=np.float32) for w in weights]
+
+    def get(self, game, run_number, version, model):
+        # the channels first weights of a version, shaped for [model]
+        key = (run_number, version)
+        with self.lock:
+            weights = self.versions.get(key)
+        if weights is None:
+            path = weightsPath(game, run_number, version)
+            if os.path.exists(path):
+                flat = np.load(path, mmap_mode='r')
+                shapes = weightShapes(model)
+                if os.path.exists(shapesPath(path)):
+                    with open(shapesPath(path)) as f:
+                        saved = [tuple(shape) for shape in json.load(f)]
+                    if saved != shapes:
+                        raise ValueError('checkpoint %s has weights of shapes %s, the model has %s' % (path, saved, shapes))
+                sizes = [int(np.prod(shape)) for shape in shapes]
+                if sum(sizes) != len(flat):
+                    raise ValueError('checkpoint %s has %d weights, the model has %d' % (path, len(flat), sum(sizes)))
+                weights = []
+                start = 0
+                for shape, size in zip(shapes, sizes):
+                    weights.append(flat[start:start + size].reshape(shape))
+                    start += size
+            else:
+                saved = model.read(game, run_number, version)
+                sourceFormat = [layer.data_format for layer in saved.layers if isinstance(layer, Conv2D)][0]
+                weights = model.convertWeights(saved.get_weights(), sourceFormat, 'channels_first')
+            with self.lock:
+                self.versions[key] = weights
+        return weights
+
+
+writer = CheckpointWriter()
+registry = WeightRegistry()
+
+
 class Gen_Model():
-    def __init__(self, reg_const, learning_rate, input_dim, output_dim):
+    def __init__(self, reg_const, learning_rate, input_dim, output_dim, data_format = 'channels_first'):
         self.reg_const = reg_const
         self.learning_rate = learning_rate
-        self.input_dim = input_dim
+        self.planes_dim = input_dim # as GameState.binary, channels first
+        self.data_format = data_format
+        if data_format == 'channels_last':
+            self.input_dim = (input_dim[1], input_dim[2], input_dim[0])
+        else:
+            self.input_dim = input_dim
         self.output_dim = output_dim
+        self.version = 0 # bumped whenever the weights change, so cached predictions can be dropped
 
     def predict(self, x):
         return self.model.predict(x)
 
     def fit(self, states, targets, epochs, verbose, validation_split, batch_size):
+        self.version += 1
         return self.model.fit(states, targets, epochs=epochs, verbose=verbose, validation_split = validation_split, batch_size = batch_size)
 
+    def fit_generator(self, generator, steps_per_epoch, epochs, verbose):
+        self.version += 1
+        return self.model.fit_generator(generator, steps_per_epoch=steps_per_epoch, epochs=epochs, verbose=verbose)
+
+    def get_weights(self):
+        return self.model.get_weights()
+
+    def set_weights(self, weights):
+        self.model.set_weights(weights)
+        self.version += 1
+
+    def convertWeights(self, weights, sourceFormat, targetFormat):
+        # [weights] of a model of this architecture built in [sourceFormat], reordered for one
+        # built in [targetFormat]. Convolution and batch normalisation weights do not depend on
+        # the layout, only the rows of a Dense layer reading a Flatten are reordered
+        if sourceFormat == targetFormat:
+            return list(weights)
+
+        byOutput = dict((layer.output.name, layer) for layer in self.model.layers)
+        converted = []
+        for layer in self.model.layers:
+            layerWeights = list(weights[len(converted):len(converted) + len(layer.weights)])
+            flatten = byOutput.get(layer.input.name) if isinstance(layer, Dense) else None
+            if isinstance(flatten, Flatten):
+                #row i of the kernel reads input i of the flatten, map both to the channels first order
+                shape = flatten.input_shape[1:]
+                if self.data_format == 'channels_last':
+                    shape = (shape[2], shape[0], shape[1])
+                rows = np.empty(np.prod(shape), dtype=np.int64)
+                rows[_flattenOrder(shape, sourceFormat)] = np.arange(np.prod(shape))
+                layerWeights[0] = layerWeights[0][rows[_flattenOrder(shape, targetFormat)]]
+            converted.extend(layerWeights)
+        return converted
+
+    def load_version(self, game, run_number, version):
+        # swaps in the weights of a saved version, through the registry so each is read from disk once
+        weights = registry.get(game, run_number, version, self)
+        self.set_weights(self.convertWeights(weights, 'channels_first', self.data_format))
+
+    def convertBatchToModelInput(self, planes):
+        # a batch of inputs stacked like GameState.binary, in the layout this model takes
+        return toModelLayout(np.reshape(planes, (-1,) + tuple(self.planes_dim)), self.data_format)
+
     def write(self, game, version):
-        self.model.save(run_folder + 'models/version' + "{0:0>4}".format(version) + '.h5')
+        #weights only, channels first, saved on a background thread
+        weights = self.convertWeights(self.get_weights(), self.data_format, 'channels_first')
+        registry.put(game, None, version, weights)
+        writer.save(weightsPath(game, None, version), weights)
 
     def read(self, game, run_number, version):
         return load_model( run_archive_folder + game + '/run' + str(run_number).zfill(4) + "/models/version" + "{0:0>4}".format(version) + '.h5', custom_objects={'softmax_cross_entropy_with_logits': softmax_cross_entropy_with_logits})
@@ -107,8 +278,11 @@ class Gen_Model():
 
 
 class Residual_CNN(Gen_Model):
-    def __init__(self, reg_const, learning_rate, input_dim,  output_dim, hidden_layers):
-        Gen_Model.__init__(self, reg_const, learning_rate, input_dim, output_dim)
+    # [data_format] is 'channels_first' or 'channels_last', DATA_FORMAT by default. [input_dim]
+    # is always given channels first, as GameState.binary is laid out
+    def __init__(self, reg_const, learning_rate, input_dim,  output_dim, hidden_layers, data_format = None):
+        Gen_Model.__init__(self, reg_const, learning_rate, input_dim, output_dim, data_format or net_config.DATA_FORMAT)
+        self.channel_axis = 1 if self.data_format == 'channels_first' else -1
         self.hidden_layers = hidden_layers
         self.num_layers = len(hidden_layers)
         self.model = self._build_model()
@@ -120,14 +294,14 @@ class Residual_CNN(Gen_Model):
         x = Conv2D(
         filters = filters
         , kernel_size = kernel_size
-        , data_format="channels_first"
+        , data_format=self.data_format
         , padding = 'same'
         , use_bias=False
         , activation='linear'
         , kernel_regularizer = regularizers.l2(self.reg_const)
         )(x)
 
-        x = BatchNormalization(axis=1)(x)
+        x = BatchNormalization(axis=self.channel_axis)(x)
 
         x = add([input_block, x])
 
@@ -140,14 +314,14 @@ class Residual_CNN(Gen_Model):
         x = Conv2D(
         filters = filters
         , kernel_size = kernel_size
-        , data_format="channels_first"
+        , data_format=self.data_format
         , padding = 'same'
         , use_bias=False
         , activation='linear'
         , kernel_regularizer = regularizers.l2(self.reg_const)
         )(x)
 
-        x = BatchNormalization(axis=1)(x)
+        x = BatchNormalization(axis=self.channel_axis)(x)
         x = LeakyReLU()(x)
 
         return (x)
@@ -157,7 +331,7 @@ class Residual_CNN(Gen_Model):
         x = Conv2D(
         filters = 1
         , kernel_size = (1,1)
-        , data_format="channels_first"
+        , data_format=self.data_format
         , padding = 'same'
         , use_bias=False
         , activation='linear'
@@ -165,7 +339,7 @@ class Residual_CNN(Gen_Model):
         )(x)
 
 
-        x = BatchNormalization(axis=1)(x)
+        x = BatchNormalization(axis=self.channel_axis)(x)
         x = LeakyReLU()(x)
 
         x = Flatten()(x)
@@ -196,14 +370,14 @@ class Residual_CNN(Gen_Model):
         x = Conv2D(
         filters = 2
         , kernel_size = (1,1)
-        , data_format="channels_first"
+        , data_format=self.data_format
         , padding = 'same'
         , use_bias=False
         , activation='linear'
         , kernel_regularizer = regularizers.l2(self.reg_const)
         )(x)
 
-        x = BatchNormalization(axis=1)(x)
+        x = BatchNormalization(axis=self.channel_axis)(x)
         x = LeakyReLU()(x)
 
         x = Flatten()(x)
@@ -241,5 +415,5 @@ class Residual_CNN(Gen_Model):
 
     def convertToModelInput(self, state):
         inputToModel =  state.binary #np.append(state.binary, [(state.playerTurn + 1)/2] * self.input_dim[1] * self.input_dim[2])
-        inputToModel = np.reshape(inputToModel, self.input_dim) 
+        inputToModel = toModelLayout(np.reshape(inputToModel, self.planes_dim), self.data_format)
         return (inputToModel)
@@ -1,13 +1,31 @@
 #### SELF PLAY
 EPISODES = 6
+SELF_PLAY_PROCESSES = 1 # worker processes playing episodes in parallel, 1 = in this process
+INFERENCE_SERVER = False # workers send positions to one batching model in this process instead of loading their own
+INFERENCE_MAX_BATCH = 32
+INFERENCE_MAX_WAIT = 0.002 # seconds the server waits to fill a batch
+INFERENCE_BACKEND = 'keras' # 'tflite' evaluates positions with an exported TFLite copy of the model, it needs tensorflow 1.15 or later
+TFLITE_QUANTIZE = None # None, 'float16' or 'int8' weights for the TFLite copy
 MCTS_SIMS = 10
+MCTS_BATCH_SIZE = 1 # leaves evaluated per predict call, 1 = one at a time
+VIRTUAL_LOSS = 1
+MCTS_THREADS = 1 # threads searching the same tree, more than 1 evaluates through an InferenceServer
+MCTS_TREE_SIZE = 20000 # max nodes kept in the search tree, least recently used are evicted first
+PREDICTION_CACHE_SIZE = 50000 # network evaluations kept per agent, 0 to disable
 MEMORY_SIZE = 6000
+POLICY_TARGET_SIZE = 64 # (action, probability) pairs stored per position, the most likely moves are kept
 TURNS_UNTIL_TAU0 = 10 # turn on which it starts playing deterministically
 CPUCT = 1
 EPSILON = 0.2
 ALPHA = 0.8
 
 
+#### STOCKFISH FEATURE PLANES
+STOCKFISH_PATH = './stockfish'
+STOCKFISH_PROCESSES = 2
+STOCKFISH_DEPTH = 5
+
+
 #### RETRAINING
 BATCH_SIZE = 256
 EPOCHS = 1
@@ -15,6 +33,13 @@ REG_CONST = 0.0001
 LEARNING_RATE = 0.1
 MOMENTUM = 0.9
 TRAINING_LOOPS = 10
+FIT_BATCH_SIZE = 32 # positions per gradient step
+TRAINING_WORKERS = 2 # threads assembling training batches while the model trains
+TRAINING_PREFETCH = 8 # batches kept ready ahead of training
+MEMORY_SAMPLE_SIZE = 1000 # positions the players are checked against after each retraining
+MEMORY_SAMPLE_DUMP = False # also log every prediction on them, not just the summary
+
+DATA_FORMAT = 'channels_first' # or 'channels_last', the layout TensorFlow's CPU kernels prefer
 
 HIDDEN_CNN_LAYERS = [
     {'filters':75, 'kernel_size': (4,4)}
@@ -25,6 +50,18 @@ HIDDEN_CNN_LAYERS = [
      , {'filters':75, 'kernel_size': (4,4)}
     ]
 
+
+#### ASYNCHRONOUS PIPELINE
+ASYNC_PIPELINE = False # self-play, retraining and evaluation run at the same time, see pipeline.py
+PIPELINE_ACTORS = 2 # processes playing self-play games
+PIPELINE_MAX_STALE_VERSIONS = 1 # best player versions an actor may play behind before it must load the new weights
+PIPELINE_MAX_STALE_SECONDS = 600 # longest an actor keeps playing with old weights once newer ones are published
+PIPELINE_REPLAY_RATIO = 5 # most positions trained on per new position, the learner waits for games beyond it
+
 #### EVALUATION
-EVAL_EPISODES = 20
-SCORING_THRESHOLD = 1.3
\ No newline at end of file
+EVAL_EPISODES = 150 # most games of a gating match, it stops once the SPRT is decided. About 70 on average
+SCORING_THRESHOLD = 1.3 # wins needed per loss to promote when the SPRT is still undecided
+SPRT_SCORE0 = 0.5 # score of a current player no better than the best one
+SPRT_SCORE1 = 0.6 # score of a current player that should be promoted, about 70 elo better
+SPRT_ALPHA = 0.05 # chance of promoting a player that is no better
+SPRT_BETA = 0.1 # chance of rejecting a player that is better
\ No newline at end of file
@@ -0,0 +1,215 @@
+"""
+Contains the asynchronous actor-learner training loop, used by main.py when
+ASYNC_PIPELINE is set.
+
+Self-play, retraining and evaluation run at the same time instead of taking
+turns. Actor processes keep playing self-play games with the latest published
+weights and send their positions back. The learner, the main process, adds
+them to the replay buffer and trains the current network whenever it has
+enough new data. An evaluator process plays each new version of the current
+network against the best player in the background. A version that wins
+becomes the best player and its weights are published to the actors.
+"""
+
+import queue
+import random
+import time
+
+import numpy as np
+
+import loggers as lg
+import net_config
+from game import Game
+from model import Residual_CNN
+from agent import Agent
+from memory import Memory
+from funcs import playMatches, SPRT
+from utils import spawnContext
+
+
+def _actor(spec, weights, results):
+    name, mcts_simulations, cpuct, turns_until_tau0, maxStaleVersions, maxStaleSeconds = spec
+    np.random.seed()
+    random.seed()
+
+    env = Game()
+    NN = Residual_CNN(net_config.REG_CONST, net_config.LEARNING_RATE, env.input_shape, env.action_size, net_config.HIDDEN_CNN_LAYERS)
+    agent = Agent(name, env.state_size, env.action_size, mcts_simulations, cpuct, NN)
+
+    version, published = weights.get()
+    NN.set_weights(published)
+    latest = (version, published)
+    publishedAt = None # when weights newer than the ones played with arrived
+
+    while True:
+        #only the newest published weights matter, the older ones are skipped
+        while True:
+            try:
+                latest = weights.get_nowait()
+            except queue.Empty:
+                break
+            if publishedAt == None:
+                publishedAt = time.time()
+
+        #the actor keeps its weights, and its prediction cache, until they are too far behind
+        if latest[0] - version > maxStaleVersions or (publishedAt != None and time.time() - publishedAt > maxStaleSeconds):
+            version, published = latest
+            NN.set_weights(published)
+            agent.mcts = None
+            publishedAt = None
+
+        memory = Memory(net_config.MEMORY_SIZE)
+        _, memory, _, _ = playMatches(agent, agent, 1, lg.logger_main, turns_until_tau0, memory)
+        results.put((version, memory.ltmemory.rows()))
+
+
+def _evaluator(spec, tasks, results):
+    mcts_simulations, cpuct, episodes = spec
+    np.random.seed()
+    random.seed()
+
+    env = Game()
+    players = {}
+    for name in ('best_player', 'current_player'):
+        NN = Residual_CNN(net_config.REG_CONST, net_config.LEARNING_RATE, env.input_shape, env.action_size, net_config.HIDDEN_CNN_LAYERS)
+        players[name] = Agent(name, env.state_size, env.action_size, mcts_simulations, cpuct, NN)
+
+    while True:
+        version, candidate, best = tasks.get()
+
+        players['current_player'].model.set_weights(candidate)
+        if best != None:
+            players['best_player'].model.set_weights(best)
+
+        sprt = SPRT('current_player', 'best_player')
+        scores, _, _, _ = playMatches(players['best_player'], players['current_player'], episodes, lg.logger_tourney, 0, None, stop = sprt.decided)
+        promote = sprt.promote(scores, net_config.SCORING_THRESHOLD, lg.logger_tourney)
+        results.put((version, promote, scores, sprt.llr))
+
+
+"""
+[Pipeline(env, memory, current_player, best_player, best_player_version,
+turns_until_tau0)] trains [current_player] from games played by copies of
+[best_player] in PIPELINE_ACTORS actor processes. [memory] is the Memory the
+games are added to and [best_player_version] the version of the best
+player's weights, saved again each time a new version is promoted.
+"""
+class Pipeline:
+    def __init__(self, env, memory, current_player, best_player, best_player_version, turns_until_tau0):
+        self.env = env
+        self.memory = memory
+        self.current_player = current_player
+        self.best_player = best_player
+        self.best_player_version = best_player_version
+
+        #positions one replay trains on, to hold the learner to PIPELINE_REPLAY_RATIO
+        steps = int(np.ceil(net_config.BATCH_SIZE / net_config.FIT_BATCH_SIZE)) * net_config.EPOCHS
+        self.replayPositions = steps * net_config.FIT_BATCH_SIZE * net_config.TRAINING_LOOPS
+        self.newPositions = 0
+        self.trainedPositions = 0
+        self.iteration = 0
+
+        ctx = spawnContext()
+        self.games = ctx.Queue()
+        self.weights = [ctx.Queue() for i in range(net_config.PIPELINE_ACTORS)]
+        spec = (best_player.name, best_player.MCTSsimulations, best_player.cpuct, turns_until_tau0, net_config.PIPELINE_MAX_STALE_VERSIONS, net_config.PIPELINE_MAX_STALE_SECONDS)
+        self.actors = [ctx.Process(target=_actor, args=(spec, weights, self.games), daemon=True) for weights in self.weights]
+
+        self.tasks = ctx.Queue()
+        self.verdicts = ctx.Queue()
+        spec = (current_player.MCTSsimulations, current_player.cpuct, net_config.EVAL_EPISODES)
+        self.evaluator = ctx.Process(target=_evaluator, args=(spec, self.tasks, self.verdicts), daemon=True)
+
+        self.candidate = None # (version, weights) being evaluated
+        self.evaluatedVersion = current_player.model.version
+        self.evaluatorBestVersion = None
+
+        self._publish()
+        for actor in self.actors:
+            actor.start()
+        self.evaluator.start()
+
+    def _publish(self):
+        weights = self.best_player.model.get_weights()
+        for actorWeights in self.weights:
+            actorWeights.put((self.best_player_version, weights))
+
+    def _collect(self, timeout):
+        #adds the games the actors finished, waiting up to [timeout] seconds for the first
+        try:
+            version, rows = self.games.get(timeout=timeout) if timeout > 0 else self.games.get_nowait()
+        except queue.Empty:
+            return
+        while True:
+            if rows != None:
+                self.memory.ltmemory.extend_rows(rows)
+                #the ratio only counts from when the memory is full and training starts
+                if len(self.memory.ltmemory) >= net_config.MEMORY_SIZE:
+                    self.newPositions += len(rows['value'])
+            lg.logger_main.info('GAME OF %d POSITIONS FROM BEST PLAYER VERSION %d, MEMORY SIZE %d', 0 if rows == None else len(rows['value']), version, len(self.memory.ltmemory))
+            try:
+                version, rows = self.games.get_nowait()
+            except queue.Empty:
+                return
+
+    def _canTrain(self):
+        if len(self.memory.ltmemory) < net_config.MEMORY_SIZE:
+            return False
+        #otherwise the learner would fit the same positions over and over while the actors catch up
+        return self.trainedPositions <= self.newPositions * net_config.PIPELINE_REPLAY_RATIO
+
+    def _train(self):
+        self.iteration += 1
+        print('RETRAINING, ITERATION ' + str(self.iteration) + ', MEMORY SIZE ' + str(len(self.memory.ltmemory)))
+        self.current_player.replay(self.memory.ltmemory)
+        self.trainedPositions += self.replayPositions
+
+    def _evaluate(self):
+        #one candidate at a time, always the newest version of the current player
+        if self.candidate == None and self.current_player.model.version != self.evaluatedVersion:
+            self.evaluatedVersion = self.current_player.model.version
+            self.candidate = (self.evaluatedVersion, self.current_player.model.get_weights())
+            #the evaluator only gets the best weights again when they changed
+            best = None
+            if self.evaluatorBestVersion != self.best_player_version:
+                best = self.best_player.model.get_weights()
+                self.evaluatorBestVersion = self.best_player_version
+            self.tasks.put((self.candidate[0], self.candidate[1], best))
+            lg.logger_tourney.info('EVALUATING CURRENT PLAYER VERSION %d', self.candidate[0])
+
+        if self.candidate == None:
+            return
+        try:
+            version, promote, scores, llr = self.verdicts.get_nowait()
+        except queue.Empty:
+            return
+
+        print('EVALUATION ' + str(scores) + ', SPRT LLR ' + '%.2f' % llr + ', PROMOTED ' + str(promote))
+        lg.logger_tourney.info('CURRENT PLAYER VERSION %d SCORES %s, PROMOTED %s', version, scores, promote)
+        if promote:
+            self.best_player_version = self.best_player_version + 1
+            self.best_player.model.set_weights(self.candidate[1])
+            self.best_player.model.write(self.env.name, self.best_player_version)
+            lg.logger_main.info('BEST PLAYER VERSION: %d', self.best_player_version)
+            self._publish()
+        self.candidate = None
+
+    """
+    [run()] trains until interrupted, then stops the actor and evaluator
+    processes.
+    """
+    def run(self):
+        try:
+            while True:
+                self._collect(0 if self._canTrain() else 1)
+                if self._canTrain():
+                    self._train()
+                self._evaluate()
+        finally:
+            self.close()
+
+    def close(self):
+        #the games and the evaluation still being played are not needed
+        for process in self.actors + [self.evaluator]:
+            process.terminate()
+            process.join()
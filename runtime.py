@@ -0,0 +1,222 @@
+"""
+Contains the TFLite inference backend for Residual_CNN.
+
+A Gen_Model is exported to a TFLite flatbuffer, optionally with its weights
+quantized to float16 or int8, and evaluated through the TFLite interpreter,
+which has far less overhead per call than keras' predict. Agents use it when
+INFERENCE_BACKEND is 'tflite'.
+
+Run as a script to export a saved version and compare it with keras:
+    python runtime.py <run number> <version> [float16|int8]
+or to compare the predict and fit throughput of the two network layouts:
+    python runtime.py layouts
+"""
+
+import re
+import sys
+import threading
+import time
+
+import chess
+import numpy as np
+import tensorflow as tf
+import keras.backend as K
+
+import net_config
+from game import Game, encodeBoards
+from model import Residual_CNN, toModelLayout
+from settings import run_folder
+
+
+#the TFLite converter from a session, its optimizations and float16 weights came with tensorflow 1.15
+TFLITE_MIN_VERSION = (1, 15)
+
+"""
+[checkBackend(backend)] raises a RuntimeError when the inference backend
+[backend] cannot run with the installed tensorflow, so an unusable setting is
+reported when it is chosen rather than in the middle of a search.
+"""
+def checkBackend(backend):
+    version = tuple(int(part) for part in re.match(r'(\d+)\.(\d+)', tf.__version__).groups())
+    if backend == 'tflite' and version < TFLITE_MIN_VERSION:
+        raise RuntimeError('the tflite backend needs tensorflow {}.{} or later, tensorflow {} is installed'.format(TFLITE_MIN_VERSION[0], TFLITE_MIN_VERSION[1], tf.__version__))
+
+
+"""
+[exportModel(model, quantize)] returns [model], a Residual_CNN, converted to a
+TFLite flatbuffer. [quantize] is None to keep float32 weights, 'float16' or
+'int8' for weights quantized to that type.
+"""
+def exportModel(model, quantize = None):
+    #read in the session of [model], before the copy's session becomes the keras one
+    weights = model.get_weights()
+    session = K.get_session()
+    graph = tf.Graph()
+    exportSession = tf.Session(graph=graph)
+    try:
+        with graph.as_default():
+            #a copy built in inference mode, so batch normalisation uses its moving averages
+            K.set_session(exportSession)
+            K.set_learning_phase(0)
+            copy = Residual_CNN(model.reg_const, model.learning_rate, model.planes_dim, model.output_dim, model.hidden_layers, model.data_format)
+            copy.model.set_weights(weights)
+
+            converter = tf.lite.TFLiteConverter.from_session(K.get_session(), copy.model.inputs, copy.model.outputs)
+            if quantize != None:
+                converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            if quantize == 'float16':
+                converter.target_spec.supported_types = [tf.float16]
+            return converter.convert()
+    finally:
+        K.set_session(session)
+        exportSession.close()
+
+
+"""
+[TFLiteModel(content, model)] stands in for a Gen_Model in an Agent,
+evaluating the TFLite flatbuffer [content] exported from the Gen_Model
+[model]. It takes the same inputs and has the same version as [model].
+"""
+class TFLiteModel:
+    def __init__(self, content, model):
+        self.content = content
+        self.planes_dim = model.planes_dim
+        self.data_format = model.data_format
+        self.input_dim = model.input_dim
+        self.version = model.version
+
+        self.interpreter = tf.lite.Interpreter(model_content=content)
+        self.input = self.interpreter.get_input_details()[0]['index']
+        outputs = self.interpreter.get_output_details()
+        #the value head has one output per position, the policy head one per action
+        outputs.sort(key=lambda output: output['shape'][-1])
+        self.valueOutput = outputs[0]['index']
+        self.policyOutput = outputs[1]['index']
+
+        self.batchSize = None
+        self.lock = threading.Lock() # the interpreter can only run one call at a time
+
+    @staticmethod
+    def fromModel(model, quantize = None):
+        return TFLiteModel(exportModel(model, quantize), model)
+
+    def predict(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        with self.lock:
+            if len(x) != self.batchSize:
+                self.interpreter.resize_tensor_input(self.input, [len(x)] + list(self.input_dim))
+                self.interpreter.allocate_tensors()
+                self.batchSize = len(x)
+            self.interpreter.set_tensor(self.input, x)
+            self.interpreter.invoke()
+            return [np.copy(self.interpreter.get_tensor(self.valueOutput)), np.copy(self.interpreter.get_tensor(self.policyOutput))]
+
+    def convertToModelInput(self, state):
+        inputToModel = toModelLayout(np.reshape(state.binary, self.planes_dim), self.data_format)
+        return (inputToModel)
+
+    def write(self, game, version, quantize = None):
+        suffix = '' if quantize == None else '_' + quantize
+        with open(run_folder + 'models/version' + "{0:0>4}".format(version) + suffix + '.tflite', 'wb') as f:
+            f.write(self.content)
+
+
+"""
+[driftCheck(model, other, inputs)] compares the predictions of two models on
+[inputs]: the largest value and policy probability differences and how often
+both pick the same most likely action.
+"""
+def driftCheck(model, other, inputs):
+    value, logits = model.predict(inputs)
+    otherValue, otherLogits = other.predict(inputs)
+
+    def softmax(logits):
+        odds = np.exp(logits - np.max(logits, axis=1, keepdims=True))
+        return odds / np.sum(odds, axis=1, keepdims=True)
+
+    return {
+        'value_max_abs': float(np.max(np.abs(value - otherValue)))
+        , 'policy_max_abs': float(np.max(np.abs(softmax(logits) - softmax(otherLogits))))
+        , 'top1_agreement': float(np.mean(np.argmax(logits, axis=1) == np.argmax(otherLogits, axis=1)))
+        }
+
+
+"""
+[benchmark(model, inputs, batchSizes, repeats)] returns the mean latency in
+milliseconds of one predict call for each batch size, taken from [inputs].
+"""
+def benchmark(model, inputs, batchSizes = (1, 8, 32), repeats = 50):
+    latencies = {}
+    for batchSize in batchSizes:
+        batch = inputs[:batchSize]
+        model.predict(batch)
+        start = time.time()
+        for i in range(repeats):
+            model.predict(batch)
+        latencies[batchSize] = (time.time() - start) / repeats * 1000
+    return latencies
+
+
+def randomInputs(count):
+    #planes of positions from random games, without engine evaluations
+    boards = []
+    board = chess.Board()
+    while len(boards) < count:
+        if board.is_game_over():
+            board = chess.Board()
+        board.push(np.random.choice(list(board.legal_moves)))
+        boards.append(board.copy(stack=False))
+    return encodeBoards(boards, np.zeros(count))
+
+
+"""
+[benchmarkLayouts(count, repeats)] builds the network in both layouts and
+returns, for each, the positions per second of predict on batches of 1 and
+32 and of fit on [count] positions.
+"""
+def benchmarkLayouts(count = 1024, repeats = 3):
+    env = Game()
+    planes = randomInputs(count)
+    targets = {'value_head': np.random.uniform(-1, 1, (count, 1)), 'policy_head': np.random.dirichlet([0.3] * env.action_size, count)}
+
+    throughput = {}
+    for data_format in ('channels_first', 'channels_last'):
+        NN = Residual_CNN(net_config.REG_CONST, net_config.LEARNING_RATE, env.input_shape, env.action_size, net_config.HIDDEN_CNN_LAYERS, data_format)
+        inputs = NN.convertBatchToModelInput(planes)
+        latencies = benchmark(NN, inputs, (1, 32), 20)
+        NN.fit(inputs, targets, epochs=1, verbose=0, validation_split=0, batch_size=32)
+        start = time.time()
+        for i in range(repeats):
+            NN.fit(inputs, targets, epochs=1, verbose=0, validation_split=0, batch_size=32)
+        throughput[data_format] = {
+            'predict_1': 1000 / latencies[1]
+            , 'predict_32': 32 * 1000 / latencies[32]
+            , 'fit': count * repeats / (time.time() - start)
+            }
+    return throughput
+
+
+if __name__ == '__main__' and (len(sys.argv) < 2 or (sys.argv[1] != 'layouts' and len(sys.argv) < 3)):
+    print('usage: python runtime.py <run number> <version> [float16|int8]')
+    print('       python runtime.py layouts')
+
+elif __name__ == '__main__' and sys.argv[1] == 'layouts':
+    for data_format, positions in benchmarkLayouts().items():
+        print(data_format.upper(), 'POSITIONS PER SECOND', positions)
+
+elif __name__ == '__main__':
+    run_number, version = int(sys.argv[1]), int(sys.argv[2])
+    quantize = sys.argv[3] if len(sys.argv) > 3 else None
+    checkBackend('tflite')
+
+    env = Game()
+    NN = Residual_CNN(net_config.REG_CONST, net_config.LEARNING_RATE, env.input_shape, env.action_size, net_config.HIDDEN_CNN_LAYERS)
+    NN.load_version(env.name, run_number, version)
+
+    lite = TFLiteModel.fromModel(NN, quantize)
+    lite.write(env.name, version, quantize)
+
+    inputs = NN.convertBatchToModelInput(randomInputs(256))
+    print('DRIFT', driftCheck(NN, lite, inputs))
+    print('KERAS LATENCY (ms)', benchmark(NN, inputs))
+    print('TFLITE LATENCY (ms)', benchmark(lite, inputs))
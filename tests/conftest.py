@@ -0,0 +1,24 @@
+import os
+import sys
+
+import chess.engine
+import pytest
+
+#the modules live at the top of the repository, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from game import GameState
+
+
+class StubEvaluator:
+    # stands in for the Stockfish pool, every position is level
+    def analyse(self, board, limit, key = None):
+        return chess.engine.Cp(0)
+
+    def analyse_many(self, boards, limit, keys = None):
+        return [chess.engine.Cp(0) for board in boards]
+
+
+@pytest.fixture
+def evaluator(monkeypatch):
+    monkeypatch.setattr(GameState, 'evaluator', StubEvaluator())
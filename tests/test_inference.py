@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+#the TFLite converter and the float16 quantization came with tensorflow 1.15
+pytest.importorskip('tensorflow', minversion='1.15')
+
+from agent import Agent
+from game import GameState
+from inference import InferenceServer
+from model import Residual_CNN
+from runtime import TFLiteModel
+
+HIDDEN_LAYERS = [{'filters': 8, 'kernel_size': (3, 3)}, {'filters': 8, 'kernel_size': (3, 3)}]
+STATE_SIZE = 20 * 8 * 8
+ACTION_SIZE = 64 * 72
+
+pytestmark = pytest.mark.usefixtures('evaluator')
+
+
+def agent(model):
+    player = Agent('player', STATE_SIZE, ACTION_SIZE, 1, 1, model)
+    player.backend = 'tflite'
+    return player
+
+
+def test_server_with_tflite_backend():
+    #what playMatchesParallel does with INFERENCE_SERVER and the tflite backend
+    player = agent(Residual_CNN(0.0001, 0.1, (20, 8, 8), ACTION_SIZE, HIDDEN_LAYERS))
+    server = InferenceServer(player.predictor(), 8, 0.001, 1)
+    try:
+        assert isinstance(server.model, TFLiteModel)
+
+        #a worker's agent sends its positions to the server as they are
+        worker = agent(server.client())
+        assert worker.predictor() is worker.model
+
+        state = GameState()
+        value, priors, allowedActions = worker.get_preds(state)
+        expected, expectedPriors, _ = player.get_preds(state)
+        assert np.isclose(value, expected)
+        assert np.allclose(priors, expectedPriors)
+    finally:
+        server.close()
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from loss import softmax_cross_entropy_with_logits
+
+
+def evaluate(targets, logits):
+    y_true = tf.constant(targets, dtype=tf.float32)
+    y_pred = tf.constant(logits, dtype=tf.float32)
+    loss = softmax_cross_entropy_with_logits(y_true, y_pred)
+    gradient = tf.gradients(tf.reduce_sum(loss), y_pred)[0]
+    with tf.Session() as session:
+        return session.run([loss, gradient])
+
+
+def test_matches_softmax_over_the_targets():
+    logits = np.array([[2.0, -1.0, 0.5, 3.0]])
+    targets = np.array([[0.25, 0.0, 0.75, 0.0]])
+    loss, _ = evaluate(targets, logits)
+
+    supported = logits[0, [0, 2]]
+    expected = -np.sum(targets[0, [0, 2]] * (supported - np.log(np.sum(np.exp(supported)))))
+    assert loss[0] == pytest.approx(expected, rel=1e-5)
+
+
+def test_row_without_targets_is_not_nan():
+    logits = np.array([[2.0, -1.0, 0.5, 3.0], [1.0, 1.0, 1.0, 1.0]])
+    targets = np.array([[0.0, 0.0, 0.0, 0.0], [0.5, 0.5, 0.0, 0.0]])
+    loss, gradient = evaluate(targets, logits)
+
+    assert np.all(np.isfinite(loss)) and np.all(np.isfinite(gradient))
+    assert loss[0] == 0
+    assert np.all(gradient[0] == 0)
+    assert loss[1] == pytest.approx(np.log(2), rel=1e-5)
@@ -0,0 +1,48 @@
+import chess
+import pytest
+
+from game import GameState
+from MCTS import MCTS, Node
+
+pytestmark = pytest.mark.usefixtures('evaluator')
+
+#knights out and back: the position after 3...Ng8 is the one after 1...e5
+REPETITION = ['e2e4', 'e7e5', 'g1f3', 'g8f6', 'f3g1', 'f6g8']
+
+
+def playLine(state, moves):
+    states = [state]
+    for uci in moves:
+        state, _, _ = state.takeAction(state._moveToAction(chess.Move.from_uci(uci)))
+        states.append(state)
+    return states
+
+
+def test_ids_follow_the_board():
+    for state in playLine(GameState(), REPETITION):
+        assert state.id == GameState(board=state.board.copy()).id
+
+
+def test_repeated_position_gets_its_own_id():
+    states = playLine(GameState(), REPETITION)
+    assert states[2].board.board_fen() == states[6].board.board_fen()
+    assert states[2].id != states[6].id
+
+
+def test_move_to_leaf_through_repetition():
+    root = GameState()
+    mcts = MCTS(Node(root), 1)
+    node = mcts.root
+    path = [node]
+    for uci in REPETITION:
+        node.expand([node.state._moveToAction(chess.Move.from_uci(uci))], [1.0])
+        node = mcts.getChild(node, 0)
+        path.append(node)
+
+    #the repeated position is a new leaf, not the expanded node of the first time
+    assert path[6] is not path[2]
+    assert path[6].isLeaf()
+
+    leaf, value, done, breadcrumbs = mcts.moveToLeaf()
+    assert leaf is path[6]
+    assert len(breadcrumbs) == len(REPETITION)
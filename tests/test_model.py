@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+
+import model
+from model import Residual_CNN, WeightRegistry
+
+HIDDEN_LAYERS = [{'filters': 8, 'kernel_size': (3, 3)}, {'filters': 8, 'kernel_size': (3, 3)}]
+
+
+@pytest.fixture
+def runFolder(tmp_path, monkeypatch):
+    (tmp_path / 'models').mkdir()
+    monkeypatch.setattr(model, 'run_folder', str(tmp_path) + '/')
+    return tmp_path
+
+
+def build():
+    return Residual_CNN(0.0001, 0.1, (20, 8, 8), 4608, HIDDEN_LAYERS)
+
+
+def test_checkpoint_round_trip_with_batch_normalisation(runFolder, monkeypatch):
+    saved = build()
+    #moving means and variances that differ from their initial values, like after training
+    saved.model.set_weights([np.random.uniform(0.5, 1.5, w.shape).astype(np.float32) for w in saved.get_weights()])
+    saved.write('chess', 1)
+    model.writer.flush()
+
+    #read back from disk, not from the copy registered by write
+    monkeypatch.setattr(model, 'registry', WeightRegistry())
+    loaded = build()
+    loaded.load_version('chess', None, 1)
+
+    for expected, actual in zip(saved.get_weights(), loaded.get_weights()):
+        assert np.array_equal(expected, actual)
+
+
+def test_checkpoint_of_another_architecture_is_refused(runFolder, monkeypatch):
+    build().write('chess', 1)
+    model.writer.flush()
+
+    monkeypatch.setattr(model, 'registry', WeightRegistry())
+    other = Residual_CNN(0.0001, 0.1, (20, 8, 8), 4608, HIDDEN_LAYERS[:1])
+    with pytest.raises(ValueError):
+        other.load_version('chess', None, 1)
@@ -26,8 +26,9 @@ class UniversalChessInterface:
     """
     def uci(self, options=None):
         print('id name {} {}'.format(self._engine.name(), self._engine.version()))
-        print('id name {}'.format(self._engine._author()))
-        #TODO deal with options here
+        print('id author {}'.format(self._engine.author()))
+        for option in self._engine.options():
+            print('option ' + option)
         print('uciok')
     
     """
@@ -41,8 +42,20 @@ class UniversalChessInterface:
     perhaps a value
     """
     def setoption(self, opt_str):
-        #TODO set options here
-        pass
+        tokens = opt_str.split()
+        if 'name' not in tokens:
+            return
+        if 'value' in tokens:
+            name = ' '.join(tokens[tokens.index('name') + 1:tokens.index('value')])
+            value = ' '.join(tokens[tokens.index('value') + 1:])
+        else:
+            name = ' '.join(tokens[tokens.index('name') + 1:])
+            value = None
+        try:
+            self._engine.setoption(name, value)
+        except RuntimeError as e:
+            #the option keeps its value, the GUI is told why
+            print('info string ' + str(e))
 
     """
     [isready()] resonds to the input "isready" from the GUI. The engine prints 
@@ -79,7 +92,7 @@ class UniversalChessInterface:
         if tokens[0] == 'startpos':
             self._engine.setposition(moves=moves)
         elif tokens[0] == 'fen':
-            fen = ' '.join(takewhile(lambda token: token != 'moves', tokens))
+            fen = ' '.join(takewhile(lambda token: token != 'moves', tokens[1:]))
             self._engine.setposition(fen=fen, moves=moves)
     
         
@@ -87,21 +100,32 @@ class UniversalChessInterface:
 
 
     """
-    [go()] responds to the input "go" from the GUI, indicating that the engine 
-    should calculate the best move to make based on the current board state. The 
-    engine responds with "bestmove" followed by the move in UCI notation, as 
-    required by the UCI protocol.
+    [go(go_str)] responds to the input "go" from the GUI, indicating that the 
+    engine should calculate the best move to make based on the current board 
+    state. The search runs in the background until the time budget computed 
+    from the clock in [go_str] runs out, its node limit is reached or the GUI 
+    sends "stop". The engine then responds with "bestmove" followed by the move 
+    in UCI notation, as required by the UCI protocol.
+
+    Parameter go_str: the arguments of the go command
+    Precondition: go_str is a string of UCI go arguments such as 
+    "wtime 60000 btime 60000 winc 1000 binc 1000", "movetime 5000" or "infinite"
     """
-    def go(self, searchmoves = None, movetime = 10000, infinite = False):
-        #TODO change "make_random move" to a smarter move generation function
-        if searchmoves:
-            print("searchmoves is unimplemented")
-        if infinite:
-            print("infinite is unimplemented")
+    def go(self, go_str=''):
+        tokens = go_str.split()
+        limits = {}
+        for name in ('wtime', 'btime', 'winc', 'binc', 'movestogo', 'movetime', 'nodes'):
+            if name in tokens:
+                limits[name] = int(tokens[tokens.index(name) + 1])
+        if 'infinite' in tokens:
+            limits['infinite'] = True
+        if 'searchmoves' in tokens:
+            print("info string searchmoves is unimplemented")
 
-        move = self._engine.best_move() 
-        print("bestmove "+move)
-        pass
+        self._engine.start_search(self.bestmove, **limits)
+
+    def bestmove(self, move):
+        print("bestmove " + move, flush=True)
 
 
     # """
@@ -130,10 +154,11 @@ class UniversalChessInterface:
             elif (input_str.startswith("position")):
                 self.position(input_str[9:])
             elif (input_str.startswith("go")):
-                self.go()
+                self.go(input_str[3:])
             elif (input_str == "stop"):
                 self._engine.stop()
             elif (input_str == "quit"):
+                self._engine.stop()
                 break
             else:
                 print('invalid command')
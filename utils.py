@@ -1,16 +1,31 @@
 
+import atexit
 import logging
+import logging.handlers
+import multiprocessing
+import queue
 
 def setup_logger(name, log_file, level=logging.INFO):
 
     formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
 
-    handler = logging.FileHandler(log_file)        
+    #the file is only opened when the first record is written
+    handler = logging.FileHandler(log_file, delay=True)
     handler.setFormatter(formatter)
 
     logger = logging.getLogger(name)
     logger.setLevel(level)
     if not logger.handlers:
-        logger.addHandler(handler)
+        #callers only queue the record, a background thread does the file writes
+        records = queue.Queue()
+        listener = logging.handlers.QueueListener(records, handler)
+        listener.start()
+        atexit.register(listener.stop)
+        logger.addHandler(logging.handlers.QueueHandler(records))
 
     return logger
+
+def spawnContext():
+    #worker processes are spawned rather than forked: a forked child would share the
+    #parent's keras session and Stockfish pool, a spawned one builds its own
+    return multiprocessing.get_context('spawn')